@@ -0,0 +1,162 @@
+"""Headless benchmarks for the effects, palettes and output path.
+
+    python -m benchmarks.run                        # run and print
+    python -m benchmarks.run --save baseline.json   # record a baseline
+    python -m benchmarks.run --baseline baseline.json --threshold 0.15
+
+With --baseline the run exits with status 1 when a case is slower, or
+allocates more per frame, than the baseline by more than the threshold.
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+from benchmarks import stubs
+
+LED_COUNTS = (263, 1000, 5000, 20000, 50000)
+SECTION_COUNTS = (1, 4, 16, 64)
+EFFECTS = ("Sparks", "SparksBatch", "Roll", "Fade")
+
+def setup_effects(cls_name, leds, sections):
+    import effects.batch as batch
+    import effects.heat as heat
+    import leds_pi.led_controller as led_controller
+    import leds_pi.led_strip as led_strip
+    import leds_pi.palette as palette
+    import leds_pi.rpi_ws281x_ext as rpi_ws281x_ext
+
+    controller = led_controller.LedController(refresh_rate=60, name=f"bench_{cls_name}_{leds}_{sections}",
+                                              gpio=12, led_count=leds, strip_type="RGB")
+    pal = palette.Palette(colors=[[0,0,0], [255,128,0], [255,255,255]], color_correction=[255,120,120], res=255)
+    size = leds // sections
+    sims = []
+    for n in range(sections):
+        section = led_strip.LedStripSection(controller, [n * size, (n + 1) * size, 1])
+        sims.append(getattr(heat, cls_name.replace("Batch", ""))(pixels=section, palette=pal, min_heat=20,
+                                                                 cold_down=-150, sparks=30, spark=255))
+    controller.stop()
+    rpi_ws281x_ext.Ws2811.begin()
+    units = [batch.SparksBatch(sims)] if cls_name == "SparksBatch" else sims
+
+    def step():
+        for unit in units:
+            unit.update()
+        controller.refresh()
+    step.keep = (controller, sims)
+    return step
+
+def setup_palette(kind, leds):
+    import numpy as np
+    import leds_pi.palette as palette
+
+    pal = palette.Palette(colors=[[0,0,0], [255,128,0], [255,255,255]], color_correction=[255,120,120], res=255)
+    heat = np.random.default_rng(0).uniform(0, 255, leds).astype(np.float16)
+    if kind == "interp":
+        def step():
+            pal.correct_color(pal.interp(heat))
+    else:
+        out = np.zeros([leds, 3], dtype=np.uint8)
+        index = np.zeros(leds, dtype=np.intp)
+        def step():
+            pal.lookup(heat, out=out, index=index)
+    return step
+
+def setup_strip(leds):
+    import numpy as np
+    import leds_pi.led_strip as led_strip
+
+    strip = led_strip.LedStrip(gpio=12, led_count=leds, strip_type="RGB")
+    frame = np.random.default_rng(0).integers(0, 256, [leds, 3], dtype=np.uint8)
+    def step():
+        strip[:] = frame
+    step.keep = strip
+    return step
+
+def cases(leds_counts, section_counts):
+    for leds in leds_counts:
+        for cls_name in EFFECTS:
+            for sections in section_counts:
+                if sections <= leds:
+                    yield f"effect/{cls_name}/leds={leds}/sections={sections}", \
+                        lambda c=cls_name, l=leds, s=sections: setup_effects(c, l, s)
+        yield f"palette/interp_correct/leds={leds}", lambda l=leds: setup_palette("interp", l)
+        yield f"palette/lookup/leds={leds}", lambda l=leds: setup_palette("lookup", l)
+        yield f"strip/setitem/leds={leds}", lambda l=leds: setup_strip(l)
+
+def measure(step, duration):
+    # Warm up, then time as many frames as fit in duration
+    for _ in range(3):
+        step()
+    frames = 0
+    start = time.perf_counter()
+    elapsed = 0
+    while elapsed < duration:
+        step()
+        frames += 1
+        elapsed = time.perf_counter() - start
+    fps = frames / elapsed
+
+    tracemalloc.start()
+    step()
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    step()
+    alloc = tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return {"fps": fps, "alloc_bytes": alloc}
+
+def compare(results, baseline, threshold):
+    failures = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result["fps"] < base["fps"] * (1 - threshold):
+            failures.append(f"{name}: {result['fps']:.1f} fps < baseline {base['fps']:.1f} fps")
+        # Small absolute slack so a few bytes of Python objects do not fail a case
+        if result["alloc_bytes"] > base["alloc_bytes"] * (1 + threshold) + 1024:
+            failures.append(f"{name}: {result['alloc_bytes']} B/frame > baseline {base['alloc_bytes']} B/frame")
+    return failures
+
+g_parser = argparse.ArgumentParser(prog='LED Controller benchmarks')
+g_parser.add_argument('-k', '--filter', type=str, default="", help="only run cases containing this text")
+g_parser.add_argument('--leds', type=int, nargs='+', default=LED_COUNTS)
+g_parser.add_argument('--sections', type=int, nargs='+', default=SECTION_COUNTS)
+g_parser.add_argument('--duration', type=float, default=0.5, help="seconds per case")
+g_parser.add_argument('--save', type=str, help="write the results to this JSON file")
+g_parser.add_argument('--baseline', type=str, help="compare against this JSON file")
+g_parser.add_argument('--threshold', type=float, default=0.1, help="allowed relative regression")
+g_parser.add_argument('--hardware', action='store_true', help="use the real RPi modules instead of stubs")
+
+def main(argv=None):
+    args = g_parser.parse_args(argv)
+    if not args.hardware:
+        stubs.install()
+    import numpy as np
+
+    results = {}
+    for name, setup in cases(args.leds, args.sections):
+        if args.filter not in name:
+            continue
+        results[name] = measure(setup(), args.duration)
+        print(f"{name:45} {results[name]['fps']:12.1f} fps {results[name]['alloc_bytes']:10d} B/frame", flush=True)
+
+    if args.save is not None:
+        with open(args.save, 'w') as file:
+            json.dump({"python": platform.python_version(), "numpy": np.__version__,
+                       "machine": platform.machine(), "cases": results}, file, indent=4)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)["cases"]
+        failures = compare(results, baseline, args.threshold)
+        for failure in failures:
+            print(f"REGRESSION {failure}")
+        return 1 if len(failures) > 0 else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
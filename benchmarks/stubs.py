@@ -0,0 +1,103 @@
+"""Stand-ins for the Raspberry Pi only modules, so the effects, palettes and
+output path can be imported and measured on any machine.
+"""
+import ctypes
+import logging
+import sys
+import types
+
+def _gpio():
+    gpio = types.ModuleType("RPi.GPIO")
+    gpio.BCM = 11
+    gpio.OUT = 0
+    gpio.HIGH = 1
+    gpio.LOW = 0
+    gpio.setmode = lambda mode: None
+    gpio.setup = lambda pin, mode: None
+    gpio.output = lambda pin, value: None
+    rpi = types.ModuleType("RPi")
+    rpi.GPIO = gpio
+    return {"RPi": rpi, "RPi.GPIO": gpio}
+
+def _journal():
+    class JournalHandler(logging.NullHandler):
+        pass
+    journal = types.ModuleType("systemd.journal")
+    journal.JournalHandler = JournalHandler
+    systemd = types.ModuleType("systemd")
+    systemd.journal = journal
+    return {"systemd": systemd, "systemd.journal": journal}
+
+class _Channel:
+    def __init__(self):
+        self.count = 0
+        self.gpionum = 0
+        self.invert = 0
+        self.brightness = 0
+        self.strip_type = 0
+        self.gamma = None
+        self.leds = None
+
+class _Driver:
+    def __init__(self):
+        self.channels = [_Channel(), _Channel()]
+        self.freq = 0
+        self.dmanum = 0
+        self.renders = 0
+
+class _Pointer:
+    def __init__(self, array):
+        self.array = array
+
+    def __int__(self):
+        return ctypes.addressof(self.array) if self.array is not None else 0
+
+def _ws():
+    ws = types.ModuleType("_rpi_ws281x")
+    ws.WS2811_STRIP_RGB = 0x00100800
+    ws.WS2811_STRIP_GRB = 0x00081000
+    ws.SK6812_STRIP_RGBW = 0x18100800
+    ws.SK6812_SHIFT_WMASK = 0xf0000000
+    ws.new_ws2811_t = _Driver
+    ws.delete_ws2811_t = lambda leds: None
+    ws.ws2811_channel_get = lambda leds, channel: leds.channels[channel]
+    for field in ("freq", "dmanum"):
+        setattr(ws, f"ws2811_t_{field}_set", lambda leds, value, field=field: setattr(leds, field, value))
+    for field in ("count", "gpionum", "invert", "brightness", "strip_type", "gamma"):
+        setattr(ws, f"ws2811_channel_t_{field}_set", lambda ch, value, field=field: setattr(ch, field, value))
+        setattr(ws, f"ws2811_channel_t_{field}_get", lambda ch, field=field: getattr(ch, field))
+    ws.ws2811_channel_t_leds_get = lambda ch: _Pointer(ch.leds)
+
+    def init(leds):
+        for ch in leds.channels:
+            ch.leds = (ctypes.c_uint32 * ch.count)() if ch.count > 0 else None
+        return 0
+
+    def fini(leds):
+        for ch in leds.channels:
+            ch.leds = None
+
+    def render(leds):
+        leds.renders += 1
+        return 0
+
+    def led_set(ch, n, value):
+        ch.leds[n] = value
+        return 0
+
+    ws.ws2811_init = init
+    ws.ws2811_fini = fini
+    ws.ws2811_render = render
+    ws.ws2811_wait = lambda leds: 0
+    ws.ws2811_get_return_t_str = lambda resp: f"stub error {resp}"
+    ws.ws2811_led_set = led_set
+    ws.ws2811_led_get = lambda ch, n: ch.leds[n]
+    return {"_rpi_ws281x": ws}
+
+def install():
+    """Register the stubs in sys.modules. Must run before importing util,
+    leds_pi, effects or led_controler.
+    """
+    for modules in (_gpio(), _journal(), _ws()):
+        for name, module in modules.items():
+            sys.modules[name] = module
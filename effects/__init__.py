@@ -1,2 +1,2 @@
-import effects.base
-import effects.heat
\ No newline at end of file
+# Submodules are imported on use; "@import:effects" loads all of them
+__all__ = ["base", "batch", "cache", "heat"]
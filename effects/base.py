@@ -1,9 +1,22 @@
 import numpy as np
 import util.logger as logger
+import effects.cache as cache
 
 class SimBase:
-    def __init__(self, pixels, palette, **kwargs):
-        self.rng = np.random.default_rng()
+    """Base of the effects. update(dt) advances the effect by dt seconds,
+    so rates are per second and the speed of the show does not depend on
+    the refresh rate or on late frames.
+    """
+    # Attributes that change the frames of the effect, see cache_key()
+    PARAMS = ()
+    # Nominal seconds between updates, set by the EffectsUpdater
+    frame_time = 1/60
+
+    def __init__(self, pixels, palette, layer = 0, blend = "replace", alpha = 1.0, cache = False, seed = None, **kwargs):
+        self.rng = np.random.default_rng(seed)
+        self.layer = layer
+        self.blend = blend
+        self.alpha = alpha
         self.pixels = pixels
         try:
             self.pixels.activate(self)
@@ -13,6 +26,9 @@ class SimBase:
         self.palette = palette
         self.leds_count = kwargs.get('leds_count', len(self.pixels))
         self.leds = np.zeros([self.leds_count,3], dtype = np.int16)
+        self.frames = None
+        if cache:
+            self.enable_cache()
 
     def __del__(self):
         try:
@@ -20,9 +36,43 @@ class SimBase:
         except AttributeError as e:
             logger.error(e)
 
-    def update(self):
-        self.pixels[:] = self.get_leds()
-        self.pixels.show()
+    def update(self, dt=None):
+        if dt is None:
+            dt = self.frame_time
+        if self.frames is not None:
+            if self.frames.play(dt):
+                return
+            if self.frames.active:
+                # A cycle only repeats with a constant step
+                dt = self.frame_time
+        leds = self.get_leds()
+        self.pixels.render(self, leds)
+        if self.frames is not None:
+            self.frames.record(leds)
+        self.step(dt)
+
+    def step(self, dt):
+        pass
+
+    def enable_cache(self, max_period = 4096):
+        if self.frames is None:
+            self.frames = cache.CycleCache(self, max_period)
+
+    def disable_cache(self):
+        if self.frames is not None:
+            self.frames.reset(None)
+            self.frames = None
+
+    def cache_key(self):
+        return (getattr(self.palette, 'version', None),) + tuple(getattr(self, p) for p in self.PARAMS)
+
+    def cycle_period(self):
+        """Number of frames of a cycle at frame_time, for effects that know it."""
+        return None
+
+    def cycle_state(self):
+        """Hashable snapshot of the state, or None if the effect is not periodic."""
+        return None
 
     def get_leds(self):
         self.leds = self.palette.correct_color(self.leds)
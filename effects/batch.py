@@ -0,0 +1,135 @@
+import numpy as np
+
+class SparksBatch:
+    """Advance many Sparks instances as one struct-of-arrays.
+
+    The heat and leds of every instance become views into one concatenated
+    array, parameters become per-instance (or per-led) vectors, and every
+    frame is one clip, one lookup into the stacked palette tables and one
+    cold down / spark step for all of them, with the same per second rates
+    as Sparks. Parameters are read when the batch is built. The step works
+    in preallocated scratch arrays and draws spark positions from the
+    generator in batches, like Sparks.
+    """
+    def __init__(self, sims):
+        self.sims = sims
+        self.rng = sims[0].rng
+        counts = np.array([s.leds_count for s in sims], dtype=np.intp)
+        self.offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.intp)
+        total = int(self.offsets[-1])
+        self.counts = counts
+        self.segment = np.repeat(np.arange(len(sims)), counts)
+
+        self.heat = np.zeros(total, dtype=np.float32)
+        self.leds = np.zeros([total, 3], dtype=np.uint8)
+        self.index = np.zeros(total, dtype=np.intp)
+        self.delta = np.zeros(total, dtype=np.float32)
+        for n, s in enumerate(sims):
+            start, stop = self.offsets[n], self.offsets[n + 1]
+            self.heat[start:stop] = s.heat
+            s.heat = self.heat[start:stop]
+            s.leds = self.leds[start:stop]
+
+        self.min_heat = np.repeat(np.array([s.min_heat for s in sims], dtype=np.float32), counts)
+        self.max_heat = np.repeat(np.array([s.max_heat for s in sims], dtype=np.float32), counts)
+        self.cold_down = np.array([s.cold_down for s in sims], dtype=np.float64)
+        self.sparks = np.array([s.sparks for s in sims], dtype=np.float64)
+        self.spark = np.array([s.spark for s in sims], dtype=np.float32)
+        self.cold_down_val = np.array([s.cold_down_val for s in sims], dtype=np.float64)
+        self.sparks_val = np.array([s.sparks_val for s in sims], dtype=np.float64)
+        self.versions = None
+        self.frame_time = sims[0].frame_time
+
+        # Per instance scratch of step()
+        self.instances = np.arange(len(sims), dtype=np.intp)
+        self.sizes = counts.astype(np.float64)
+        self.scratch = np.zeros(len(sims), dtype=np.float64)
+        self.cool = np.zeros(len(sims), dtype=bool)
+        self.cool_val = np.zeros(len(sims), dtype=np.float32)
+        self.spark_counts = np.zeros(len(sims), dtype=np.intp)
+        # Per spark scratch, grown when a step sets more sparks
+        self.__spark_buffers(256)
+        self.drawn = len(self.uniform)
+
+    def __spark_buffers(self, size):
+        self.uniform = np.zeros(size, dtype=np.float64)
+        self.scaled = np.zeros(size, dtype=np.float64)
+        self.positions = np.zeros(size, dtype=np.intp)
+        self.starts = np.zeros(size, dtype=np.intp)
+        self.values = np.zeros(size, dtype=np.float32)
+
+    def draw(self, count):
+        """Uniform numbers in [0, 1), drawn from rng 256 at a time."""
+        if self.drawn + count > len(self.uniform):
+            if count > len(self.uniform):
+                self.__spark_buffers(count)
+            self.rng.random(out=self.uniform)
+            self.drawn = 0
+        self.drawn += count
+        return self.uniform[self.drawn - count:self.drawn]
+
+    def __compile(self):
+        # Stack the palette tables and offset each led into its own table
+        palettes = []
+        for s in self.sims:
+            if s.palette not in palettes:
+                palettes.append(s.palette)
+        starts = np.cumsum([0] + [len(p.lut) for p in palettes])
+        self.lut = np.concatenate([p.lut for p in palettes])
+        first = np.array([starts[palettes.index(s.palette)] for s in self.sims], dtype=np.intp)
+        last = np.array([starts[palettes.index(s.palette)] + len(s.palette.lut) - 1 for s in self.sims], dtype=np.intp)
+        self.lut_first = np.repeat(first, self.counts)
+        self.lut_last = np.repeat(last, self.counts)
+        self.palettes = palettes
+        self.versions = [p.version for p in palettes]
+
+    def get_leds(self):
+        if self.versions is None or self.versions != [p.version for p in self.palettes]:
+            self.__compile()
+        np.clip(self.heat, self.min_heat, self.max_heat, out=self.heat)
+        # Rounded as Palette.lookup does
+        np.rint(self.heat, out=self.index, casting='unsafe')
+        np.maximum(self.index, 0, out=self.index)
+        np.add(self.index, self.lut_first, out=self.index)
+        np.minimum(self.index, self.lut_last, out=self.index)
+        return np.take(self.lut, self.index, axis=0, out=self.leds)
+
+    def step(self, dt):
+        np.multiply(self.cold_down, dt, out=self.scratch)
+        np.add(self.cold_down_val, self.scratch, out=self.cold_down_val)
+        np.abs(self.cold_down_val, out=self.scratch)
+        np.greater(self.scratch, 1, out=self.cool)
+        # Instances below one step of heat cool by 0
+        np.multiply(self.cold_down_val, self.cool, out=self.cool_val, casting='same_kind')
+        np.take(self.cool_val, self.segment, out=self.delta)
+        np.add(self.heat, self.delta, out=self.heat)
+        np.copyto(self.cold_down_val, 0, where=self.cool)
+
+        np.multiply(self.sparks, dt, out=self.scratch)
+        np.add(self.sparks_val, self.scratch, out=self.sparks_val)
+        np.copyto(self.spark_counts, self.sparks_val, casting='unsafe')
+        total = int(self.spark_counts.sum())
+        if total > 0:
+            uniform = self.draw(total)
+            # Instance of every spark, only total entries
+            segment = np.repeat(self.instances, self.spark_counts)
+            scaled = self.scaled[:total]
+            positions = self.positions[:total]
+            starts = self.starts[:total]
+            values = self.values[:total]
+            np.take(self.sizes, segment, out=scaled)
+            np.multiply(scaled, uniform, out=scaled)
+            np.copyto(positions, scaled, casting='unsafe')
+            np.take(self.offsets, segment, out=starts)
+            np.add(positions, starts, out=positions)
+            np.take(self.spark, segment, out=values)
+            self.heat[positions] = values
+            np.subtract(self.sparks_val, self.spark_counts, out=self.sparks_val)
+
+    def update(self, dt=None):
+        if dt is None:
+            dt = self.frame_time
+        self.get_leds()
+        for s in self.sims:
+            s.pixels.render(s, s.leds)
+        self.step(dt)
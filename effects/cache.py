@@ -0,0 +1,155 @@
+import collections
+import hashlib
+import threading
+import numpy as np
+import util.logger as logger
+import util.singleton as singleton
+from util.config import DataClass
+
+@singleton.Singleton
+class FrameCache:
+    """Process wide memory budget for the frames cached by CycleCaches.
+    Caches are evicted least recently played first. The caches are played
+    from the threads of several pools, so the accounting is under a lock.
+    """
+    def __init__(self) -> None:
+        self.max_bytes = 64 * 1024 * 1024
+        self.used = 0
+        self._entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def reserve(self, cache, nbytes):
+        if nbytes > self.max_bytes:
+            return False
+        with self.lock:
+            while self.used + nbytes > self.max_bytes:
+                # The size is kept with the entry, the victim may not have
+                # stored its frames yet
+                _, (victim, size) = self._entries.popitem(last=False)
+                logger.info("Frame cache full, evicting %s", victim.name, extra={"ratelimit": True})
+                self.used -= size
+                victim.evict()
+            self._entries[id(cache)] = (cache, nbytes)
+            self.used += nbytes
+        return True
+
+    def release(self, cache, nbytes):
+        with self.lock:
+            if self._entries.pop(id(cache), None) is not None:
+                self.used -= nbytes
+
+    def touch(self, cache):
+        with self.lock:
+            if id(cache) in self._entries:
+                self._entries.move_to_end(id(cache))
+
+@DataClass(name="FrameCache")
+def configure_frame_cache(max_bytes = 64 * 1024 * 1024, **kwargs):
+    FrameCache.max_bytes = max_bytes
+    return FrameCache
+
+def _digest(state):
+    # The seen states are kept by digest, a snapshot may be as large as a frame
+    digest = hashlib.blake2b(digest_size=16)
+    for part in state if isinstance(state, tuple) else (state,):
+        digest.update(part if isinstance(part, bytes) else repr(part).encode())
+        digest.update(b"\0")
+    return digest.digest()
+
+class CycleCache:
+    """Record the frames of one cycle of a periodic effect and loop over them.
+
+    The effect either declares its period with cycle_period(), or exposes a
+    cycle_state() snapshot and the period is found when a state repeats.
+    The frames are dropped when cache_key() changes (parameters or palette)
+    or when the FrameCache evicts them. Frames are recorded one per
+    frame_time of the effect and played back by elapsed time.
+    """
+    def __init__(self, effect, max_period = 4096):
+        self.effect = effect
+        self.max_period = max_period
+        self.key = None
+        self.reset(None)
+
+    @property
+    def name(self):
+        return getattr(self.effect, 'name', type(self.effect).__name__)
+
+    def reset(self, key):
+        if getattr(self, 'frames', None) is not None:
+            FrameCache.release(self, self.frames.nbytes)
+        self.key = key
+        self.frames = None
+        self.position = 0
+        self.elapsed = 0.0
+        self.seen = {}
+        self.recorded = []
+        self.active = True
+
+    def evict(self):
+        self.frames = None
+        self.seen = {}
+        self.recorded = []
+        # Do not record again until the effect changes
+        self.active = False
+
+    def play(self, dt):
+        """Render the cached frame and advance by dt seconds. Return False
+        when the effect has to compute the frame itself."""
+        key = self.effect.cache_key()
+        if key != self.key:
+            self.reset(key)
+        # The FrameCache may evict the frames from another thread
+        cached = self.frames
+        if cached is None:
+            return False
+        FrameCache.touch(self)
+        self.effect.pixels.render(self.effect, cached[self.position])
+        # Round, so jitter around frame_time advances one frame at a time
+        self.elapsed += dt
+        frames = int(self.elapsed / self.effect.frame_time + 0.5)
+        self.elapsed -= frames * self.effect.frame_time
+        self.position = (self.position + frames) % len(cached)
+        return True
+
+    def record(self, frame):
+        """Remember the frame rendered for the current state of the effect."""
+        if not self.active:
+            return
+        period = self.effect.cycle_period()
+        if period is not None:
+            self.recorded.append(np.array(frame, dtype=np.uint8))
+            if len(self.recorded) == period:
+                self.__store(0)
+            return
+        state = self.effect.cycle_state()
+        if state is None or len(self.recorded) >= self.max_period:
+            self.active = False
+            self.recorded = []
+            self.seen = {}
+            return
+        key = _digest(state)
+        start = self.seen.get(key)
+        frame = np.array(frame, dtype=np.uint8)
+        # Confirm a digest match against the frame recorded for that state
+        if start is not None and np.array_equal(self.recorded[start], frame):
+            # The frame just rendered is the first frame of the cycle
+            self.__store(start, 1)
+            return
+        self.seen[key] = len(self.recorded)
+        self.recorded.append(frame)
+
+    def __store(self, start, position=0):
+        frames = np.stack(self.recorded[start:])
+        self.recorded = []
+        self.seen = {}
+        self.active = False
+        # Stored before the reservation, another thread may evict them as
+        # soon as they are reserved
+        self.frames = frames
+        self.position = position % len(frames)
+        self.elapsed = 0.0
+        if not FrameCache.reserve(self, frames.nbytes):
+            self.frames = None
+        else:
+            logger.info("Caching %d frames cycle of %s", len(frames), self.name)
@@ -1,26 +1,31 @@
 import numpy as np
-import random
 
 from util.config import DataClass
 from effects.base import SimBase
+import effects.batch as batch
 
 class HeatBase(SimBase):
+    PARAMS = ("min_heat", "max_heat")
+
     def __init__(self, min_heat = 0, max_heat = None, **kwargs):
         super().__init__(**kwargs)
         self.min_heat = min_heat
         self.max_heat = max_heat if max_heat is not None else self.palette.res
-        self.heat = np.zeros(self.leds_count, dtype=np.float16)
-
-    def update(self):
-        super().update()
+        self.heat = np.zeros(self.leds_count, dtype=np.float32)
+        self.index = np.zeros(self.leds_count, dtype=np.intp)
+        self.leds = np.zeros([self.leds_count,3], dtype=np.uint8)
 
     def get_leds(self):
-        self.heat = np.clip(self.heat, self.min_heat, self.max_heat)
-        self.leds = self.palette.interp(self.heat)
-        return super().get_leds()
+        np.clip(self.heat, self.min_heat, self.max_heat, out=self.heat)
+        return self.palette.lookup(self.heat, out=self.leds, index=self.index)
     
 @DataClass(name="Sparks")
 class Sparks(HeatBase):
+    """Random sparks that cool down. cold_down is the heat lost per second
+    and sparks the number of sparks per second."""
+    PARAMS = HeatBase.PARAMS + ("cold_down", "sparks", "spark")
+    BATCH = batch.SparksBatch
+
     def __init__(self, cold_down = 0, sparks = 3, spark = None, **kwargs):
         super().__init__(**kwargs)
         self.cold_down = cold_down
@@ -28,51 +33,95 @@ class Sparks(HeatBase):
         self.spark = spark if spark is not None else self.max_heat
         self.cold_down_val = 0
         self.sparks_val = 0
+        # Spark positions are drawn from self.rng in batches
+        self.uniform = np.zeros(256, dtype=np.float64)
+        self.positions = np.zeros(256, dtype=np.intp)
+        self.drawn = len(self.positions)
+
+    def draw(self, count):
+        if self.drawn + count > len(self.positions):
+            if count > len(self.positions):
+                self.uniform = np.zeros(count, dtype=np.float64)
+                self.positions = np.zeros(count, dtype=np.intp)
+            self.rng.random(out=self.uniform)
+            np.multiply(self.uniform, self.leds_count, out=self.uniform)
+            np.copyto(self.positions, self.uniform, casting='unsafe')
+            self.drawn = 0
+        self.drawn += count
+        return self.positions[self.drawn - count:self.drawn]
 
-    def update(self):
-        super().update()
-        self.cold_down_val += self.cold_down
+    def step(self, dt):
+        self.cold_down_val += self.cold_down * dt
         if self.cold_down_val > 1 or self.cold_down_val < -1:
             self.heat += self.cold_down_val
             self.cold_down_val = 0
 
-        self.sparks_val += self.sparks
-        if self.sparks_val > 1:
-            for n in range(int(self.sparks_val)):
-                j = random.randint(0,self.leds_count-1)
-                self.heat[j] = self.spark
-            self.sparks_val = 0
+        self.sparks_val += self.sparks * dt
+        if self.sparks_val >= 1:
+            count = int(self.sparks_val)
+            self.heat[self.draw(count)] = self.spark
+            self.sparks_val -= count
 
 @DataClass(name="Roll")
 class Roll(HeatBase):
-    def __init__(self, speed = 1, **kwargs):
+    """Scroll a heat ramp along the strip. step_rate is the number of leds
+    the ramp moves per second and speed the heat change per second of the
+    led entering the strip."""
+    PARAMS = HeatBase.PARAMS + ("speed", "step_rate")
+
+    def __init__(self, speed = 60, step_rate = 60, **kwargs):
         super().__init__(**kwargs)
         self.speed = speed
+        self.step_rate = step_rate
         self.current = self.min_heat
+        # Fraction of a led the ramp moved since the last whole step
+        self.shift = 0.0
+        # heat is a ring buffer, the first led is at heat[head]
+        self.head = 0
+
+    def get_leds(self):
+        np.clip(self.heat, self.min_heat, self.max_heat, out=self.heat)
+        tail = self.leds_count - self.head
+        self.palette.lookup(self.heat[self.head:], out=self.leds[:tail], index=self.index[:tail])
+        self.palette.lookup(self.heat[:self.head], out=self.leds[tail:], index=self.index[tail:])
+        return self.leds
 
-    def update(self):
-        super().update()
-        self.current += self.speed
-        if self.current > self.max_heat:
-            self.current = self.min_heat
-        elif self.current < self.min_heat:
-            self.current = self.max_heat
-        self.heat = np.roll(self.heat, 1)
-        self.heat[0] = self.current
+    def step(self, dt):
+        if self.step_rate <= 0:
+            return
+        self.shift += self.step_rate * dt
+        steps = int(self.shift)
+        self.shift -= steps
+        # Heat difference between neighbour leds
+        delta = self.speed / self.step_rate
+        for _ in range(min(steps, self.leds_count)):
+            self.current += delta
+            if self.current > self.max_heat:
+                self.current = self.min_heat
+            elif self.current < self.min_heat:
+                self.current = self.max_heat
+            self.head = (self.head - 1) % self.leds_count
+            self.heat[self.head] = self.current
+
+    def cycle_state(self):
+        return (self.current, self.shift, self.heat[self.head:].tobytes() + self.heat[:self.head].tobytes())
 
 @DataClass(name="Fade")
 class Fade(HeatBase):
-    def __init__(self, color = (255, 255, 255), **kwargs):
+    """Fade a color in and out, scale is the brightness change per second."""
+    PARAMS = ("color", "scale")
+
+    def __init__(self, color = (255, 255, 255), scale = 0.06, **kwargs):
         super().__init__(**kwargs)
         self.color = color
-        for n in range(self.leds_count):
-            self.leds[n] = self.color
+        self.leds[:] = self.color
+        self.faded = np.zeros([self.leds_count,3], dtype=np.float32)
         self.brightness = 0
         self.dir = 1
-        self.scale = .001
+        self.scale = scale
 
-    def update(self):
-        self.brightness += self.dir * self.scale
+    def step(self, dt):
+        self.brightness += self.dir * self.scale * dt
 
         if self.brightness < 0.0:
             self.brightness = 0.0
@@ -80,12 +129,10 @@ class Fade(HeatBase):
         if self.brightness > 1.0:
             self.brightness = 1.0
             self.dir = -1
-        val = int(255*self.brightness)
-        self.pixels.fill(self.color)
-        self.pixels.setBrightness(int(255*self.brightness))
-        self.pixels.show()
-    
-    def get_color(self):
-        # self.
-        return super().get_color()
+
+    def cycle_state(self):
+        return (self.brightness, self.dir)
+
+    def get_leds(self):
+        return np.multiply(self.leds, self.brightness, out=self.faded)
 
@@ -2,7 +2,11 @@ import RPi.GPIO as GPIO
 import sys
 
 import argparse
+import asyncio
 import json
+import threading
+import multiprocessing as mp
+import os
 import time
 import signal
 
@@ -11,13 +15,83 @@ import signal
 # import effects
 # import configs
 
+import util.governor as governor
 import util.logger as logger
 import util.thread_pool as thread_pool
 import util.config as config
+import util.metrics as metrics
+import leds_pi.led_controller as led_controller
+import leds_pi.recording as recording
+import leds_pi.rpi_ws281x_ext as rpi_ws281x_ext
+import leds_pi.udp_source as udp_source
+
+@config.DataClass(name="EffectsWorker")
+class EffectsWorker:
+    """Run a group of EffectsUpdaters in a forked process. Effects publish into
+    shared memory layers and the main process only composites and renders.
+    """
+    def __init__(self, name = "", cpus = None, **kwargs):
+        self.name = name
+        self.cpus = cpus
+        self.updaters = []
+        self.process = None
+        self.ctx = mp.get_context("fork")
+        self.stop_event = self.ctx.Event()
+
+    def add(self, updater):
+        self.updaters.append(updater)
+
+    def _run(self):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # The event loop of the parent does not run in this process
+        thread_pool.use_loop(None)
+        if self.cpus is not None:
+            os.sched_setaffinity(0, self.cpus)
+        for updater in self.updaters:
+            updater.start()
+        self.stop_event.wait()
+        for updater in self.updaters:
+            updater.stop()
+        # Skip atexit handlers, the driver belongs to the main process
+        os._exit(0)
+
+    def start(self):
+        updaters = [u for u in self.updaters if u.enable == True]
+        if self.process is not None or len(updaters) == 0:
+            return
+        logger.info("Starting worker %s...", self.name)
+        for updater in updaters:
+            updater.share()
+        self.updaters = updaters
+        self.stop_event.clear()
+        self.process = self.ctx.Process(target=self._run, name=self.name, daemon=True)
+        self.process.start()
+
+    def remove(self, updater):
+        if updater in self.updaters:
+            self.updaters.remove(updater)
+
+    def stop(self):
+        if self.process is None:
+            return
+        logger.info("stoping worker %s...", self.name)
+        self.stop_event.set()
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.process = None
+        for updater in self.updaters:
+            updater.unshare()
 
 @config.DataClass(name="EffectsUpdater")
 class EffectsUpdater:
-    def __init__(self,  enable, effects, name = "", refresh_rate = 15, **kwargs):
+    # Longest step an effect takes at once, after a stall the show resumes
+    # instead of jumping ahead
+    MAX_DT = 0.5
+
+    def __init__(self,  enable, effects, name = "", refresh_rate = 15, worker = None, cache = False, batch = False,
+                 priority = 0, min_rate = None, pool = None, **kwargs):
         self._stop = True
         self.thread = None
         self.enable = enable
@@ -28,75 +102,315 @@ class EffectsUpdater:
         self.name = name
         self.refresh_rate = refresh_rate
         self.frame_time = 1/refresh_rate
-        self.thread = thread_pool.TimeThread(self._run, self.frame_time)
+        # The Governor may lower rate down to min_rate, lowest priority first
+        self.rate = refresh_rate
+        self.priority = priority
+        self.min_rate = min_rate
+        self.cache = cache
+        self.rate_gauge = metrics.Metrics.gauge("updater_rate_hz", "Rate the updater runs at", updater=name)
+        self.rate_gauge.set(refresh_rate)
+        self.thread = thread_pool.TimeThread(self._run, self.frame_time, pool=pool, name=name)
+        for s in self.effects:
+            s.frame_time = self.frame_time
+        # Effects advance by the time since the last update, up to MAX_DT
+        self.last_update = None
+        self.units = self.__batch(self.effects) if batch else list(self.effects)
+        self.update_times = [metrics.Metrics.histogram("effect_update_seconds", "Time to update one effect",
+                                                       updater=name, effect=getattr(s, 'name', f"{type(s).__name__}{n}"))
+                             for n, s in enumerate(self.units)]
+        self.worker = worker
+        if self.worker is not None:
+            self.worker.add(self)
+        if cache:
+            self.enable_cache()
+
+    def __batch(self, effects):
+        # Group the instances of classes that provide a BATCH engine
+        groups = {}
+        for s in effects:
+            if getattr(type(s), 'BATCH', None) is not None:
+                groups.setdefault(type(s), []).append(s)
+        units = []
+        for s in effects:
+            group = groups.get(type(s))
+            if group is None or len(group) < 2:
+                units.append(s)
+            elif group[0] is s:
+                units.append(type(s).BATCH(group))
+        return units
 
     def _run(self):
+        now = time.perf_counter()
+        dt = self.frame_time if self.last_update is None else min(now - self.last_update, EffectsUpdater.MAX_DT)
+        self.last_update = now
+        for s, update_time in zip(self.units, self.update_times):
+            start = time.perf_counter()
+            s.update(dt)
+            update_time.observe(time.perf_counter() - start)
+
+    def set_rate(self, rate):
+        self.rate = rate
+        self.rate_gauge.set(rate)
+        self.thread.set_frame_time(1/rate)
+
+    def cacheable(self):
+        """True when a frame cache can replace computing some effects."""
+        return any(hasattr(s, 'enable_cache') and (s.cycle_period() is not None or s.cycle_state() is not None)
+                   for s in self.units)
+
+    def enable_cache(self):
         for s in self.effects:
-            s.update()
+            if hasattr(s, 'enable_cache'):
+                s.enable_cache()
+
+    def disable_cache(self):
+        for s in self.effects:
+            if hasattr(s, 'disable_cache'):
+                s.disable_cache()
+
+    def share(self):
+        for s in self.effects:
+            s.pixels.share(s)
+
+    def unshare(self):
+        for s in self.effects:
+            s.pixels.unshare(s)
+
+    def ready(self):
+        """True once every effect has a frame in its layer."""
+        return all(s.pixels.layer_ready(s) for s in self.effects)
 
     def start(self):
-        logger.info(f"Starting {self.name}...")
+        logger.info("Starting %s...", self.name)
+        self.last_update = None
         self.thread.start()
+        governor.Governor.add(self)
 
     def stop(self):
-        logger.info(f"stoping {self.name}...")
+        logger.info("stoping %s...", self.name)
+        governor.Governor.remove(self)
         self.thread.stop()
 
 class LedsController:
     def __signal(self, *args):
         self.kill_now = True
+        self.wakeup.set()
+
+    def __dump_stats(self, *args):
+        logger.info(metrics.Metrics.render())
+
+    def __request_reload(self, *args):
+        self.reload_requested = True
+        self.wakeup.set()
 
     def __init__(self):
         self.kill_now = False
         signal.signal(signal.SIGINT, self.__signal)
         signal.signal(signal.SIGTERM, self.__signal)
+        signal.signal(signal.SIGUSR1, self.__dump_stats)
+        signal.signal(signal.SIGHUP, self.__request_reload)
         GPIO.setmode(GPIO.BCM)
+        self.wakeup = threading.Event()
+        self.reload_requested = False
+        self.filename = None
+        self.watch = False
+        self.mtime = None
         self.sims = []
         self.pools = []
+        self.workers = []
+        self.recorders = []
+        self.sources = []
     
     def load_config(self, json_obj):
-        conf = config.Config.load_from_json(json_obj)
+        config.Config.load_from_json(json_obj)
+        self.__collect()
+
+    def load_config_file(self, filename, cache_dir=None, watch=False):
+        self.filename = filename
+        self.watch = watch
+        self.mtime = os.stat(filename).st_mtime_ns
+        start = time.perf_counter()
+        if cache_dir is None:
+            with open(filename, 'r') as file:
+                config.Config.load_from_json(json.load(file))
+        else:
+            config.Config.load_cached(filename, os.path.expanduser(cache_dir))
+        logger.info("Loaded %s in %.3fs", filename, time.perf_counter() - start)
+        self.__collect()
+
+    def __collect(self):
+        # Bring the driver up once, with the channels of every strip
+        rpi_ws281x_ext.Ws2811.begin()
         objs = config.Config.get_all_objects()
+        self.sims = []
+        self.pools = []
+        self.workers = []
+        self.recorders = []
+        self.sources = []
 
         for item in objs:
             if isinstance(item, EffectsUpdater):
                 self.sims.append(item)
             elif isinstance(item, thread_pool.ThreadPool):
                 self.pools.append(item)
+            elif isinstance(item, EffectsWorker):
+                self.workers.append(item)
+            elif isinstance(item, recording.FrameRecorder):
+                self.recorders.append(item)
+            elif isinstance(item, udp_source.UdpSource):
+                self.sources.append(item)
     
-    def run(self):
-        self.exit = False
-        
+    def reload(self):
+        """Load the config file again next to the running one. Objects that did
+        not change keep running; replaced effects keep their layers until the
+        new effects rendered a frame, so no frame is dropped."""
+        logger.info("Reloading %s...", self.filename)
+        try:
+            with open(self.filename, 'r') as file:
+                created, stale = config.Config.reload_from_json(json.load(file))
+        except Exception as e:
+            logger.error("Reload failed, keeping the running config: %s", e)
+            return
+        self.__collect()
+
+        # Replaced updaters stop first, their layers keep the last frame
+        restart = [w for w in self.workers if w not in created and
+                   any(u in stale or u in created for u in w.updaters)]
+        for item in stale + restart:
+            if isinstance(item, (EffectsWorker, recording.FrameRecorder, udp_source.UdpSource)):
+                item.stop()
+            elif isinstance(item, EffectsUpdater) and item.worker is None:
+                item.stop()
+        for worker in restart:
+            for updater in stale:
+                worker.remove(updater)
+
+        for item in created + restart:
+            if isinstance(item, EffectsUpdater):
+                if item.enable == True and item.worker is None:
+                    item.start()
+            elif isinstance(item, (EffectsWorker, recording.FrameRecorder, udp_source.UdpSource)):
+                item.start()
+
+        updaters = [u for u in created if isinstance(u, EffectsUpdater) and u.enable == True]
+        deadline = time.monotonic() + 2
+        while not all(u.ready() for u in updaters) and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        # Controllers removed from the config are blanked, before their pool
+        # may stop
+        for item in stale:
+            if isinstance(item, led_controller.LedController):
+                item.deinit()
+        for item in stale:
+            if isinstance(item, thread_pool.ThreadPool):
+                item.stop_all()
+            elif isinstance(item, metrics.StatsServer):
+                item.stop()
+            elif hasattr(item, 'pixels') and hasattr(item, 'update'):
+                item.pixels.release(item)
+        logger.info("Reloaded %s: %d new and %d replaced objects", self.filename, len(created), len(stale))
+
+    def __check_reload(self):
+        if self.watch and self.filename is not None:
+            try:
+                mtime = os.stat(self.filename).st_mtime_ns
+            except OSError:
+                mtime = self.mtime
+            if mtime != self.mtime:
+                self.mtime = mtime
+                self.reload_requested = True
+        if self.reload_requested:
+            self.reload_requested = False
+            self.reload()
+
+    def __start_all(self):
         for sim in self.sims:
-            if sim.enable == True:
+            if sim.enable == True and sim.worker is None:
                 sim.start()
+
+        for worker in self.workers:
+            worker.start()
+
+        for recorder in self.recorders:
+            recorder.start()
+
+        for source in self.sources:
+            source.start()
+
+    def __stop_all(self):
+        for source in self.sources:
+            source.stop()
+
+        for recorder in self.recorders:
+            recorder.stop()
+
+        for worker in self.workers:
+            worker.stop()
+
+        for sim in self.sims:
+            sim.stop()
         
+        for pool in self.pools:
+            pool.stop_all()
+
+    def run(self):
+        self.exit = False
+        self.__start_all()
         while self.exit == False and self.kill_now == False:
             try:
-                time.sleep(1)
+                # Signals wake the wait up, the timeout only polls the file
+                self.wakeup.wait(1 if self.watch else None)
+                self.wakeup.clear()
+                self.__check_reload()
             except KeyboardInterrupt:
                 logger.info("Exit")
                 self.exit = True
-        
-        for sim in self.sims:
-            sim.stop()
-        
-        for pool in self.pools:
-            pool.stop_all()
+        self.__stop_all()
+
+    async def run_async(self):
+        """Same as run() on the running event loop. Pools must be attached to
+        the loop with thread_pool.use_loop() before the config is loaded."""
+        loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        loop.add_signal_handler(signal.SIGINT, self.__signal)
+        loop.add_signal_handler(signal.SIGTERM, self.__signal)
+        loop.add_signal_handler(signal.SIGUSR1, self.__dump_stats)
+        loop.add_signal_handler(signal.SIGHUP, self.__request_reload)
+        self.__start_all()
+        while self.kill_now == False:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), 1 if self.watch else None)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            # Reloading waits for the new layers, keep the loop running
+            await loop.run_in_executor(None, self.__check_reload)
+        logger.info("Exit")
+        await loop.run_in_executor(None, self.__stop_all)
 
 
 g_parser = argparse.ArgumentParser(prog='LED Controller')
 g_parser.add_argument('-f', '--configfile', type=str, required=True)
 g_parser.add_argument('-d', '--daemon', action='store_true')
+g_parser.add_argument('--cache-dir', type=str, default=None,
+                      help="store compiled config plans in this directory, e.g. ~/.cache/leds_project")
+g_parser.add_argument('--no-cache', action='store_true', help="parse the config on every start, even with --cache-dir")
+g_parser.add_argument('-w', '--watch', action='store_true', help="reload the config when the file changes")
+g_parser.add_argument('--asyncio', action='store_true', help="schedule every task on one asyncio event loop")
 
-if __name__ == "__main__":
-    args = g_parser.parse_args()
-    conf = None
-    with open(args.configfile, 'r') as file:
-        conf = json.load(file)
+async def main_async(args):
+    thread_pool.use_loop(asyncio.get_running_loop())
     cont = LedsController()
+    cont.load_config_file(args.configfile, None if args.no_cache else args.cache_dir, args.watch)
+    await cont.run_async()
 
-    if conf is not None:
-        cont.load_config(conf)
+if __name__ == "__main__":
+    args = g_parser.parse_args()
+    if args.asyncio:
+        asyncio.run(main_async(args))
+    else:
+        cont = LedsController()
+        cont.load_config_file(args.configfile, None if args.no_cache else args.cache_dir, args.watch)
         cont.run()
     sys.exit(0)
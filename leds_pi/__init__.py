@@ -1,4 +1,2 @@
-import leds_pi.rpi_ws281x_ext
-import leds_pi.palette
-import leds_pi.led_strip
-import leds_pi.led_controller
\ No newline at end of file
+# Submodules are imported on use; "@import:leds_pi" loads all of them
+__all__ = ["rpi_ws281x_ext", "palette", "led_strip", "compositor", "coordinator", "recording", "udp_source", "led_controller"]
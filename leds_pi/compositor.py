@@ -0,0 +1,224 @@
+import numpy as np
+import threading
+import time
+from multiprocessing import shared_memory
+
+BLEND_MODES = ("replace", "add", "max", "multiply", "alpha")
+
+class Layer:
+    """Render target of one effect inside a controller frame.
+
+    The owner writes its RGB output through ``set``; the compositor blends
+    it into the section ``pos`` of the frame. ``generation`` is bumped, on the
+    layer and on the compositor, whenever the content changes.
+
+    Frames are triple buffered: ``set`` fills ``back`` without locking and
+    exchanges it with ``middle``, ``flip`` exchanges ``middle`` with the
+    front ``buffer`` at the frame boundary. ``lock`` only guards the two
+    pointer exchanges, so writers and the compositor never wait on a copy.
+    """
+    def __init__(self, pos, count, order=0, blend="replace", alpha=1.0, compositor=None, lock=None):
+        if blend not in BLEND_MODES:
+            raise KeyError(f"Blend mode '{blend}' not found")
+        self.pos = pos
+        self.order = order
+        self.blend = blend
+        self.alpha = alpha
+        self.buffer = np.zeros([count, 3], dtype=np.float32)
+        self.middle = np.zeros([count, 3], dtype=np.float32)
+        self.back = np.zeros([count, 3], dtype=np.float32)
+        # Most recent frame written, whichever buffer holds it now
+        self.latest = self.buffer
+        self.fresh = False
+        # write() keeps the previous content, flip() has to copy then
+        self.partial = False
+        self.lock = lock if lock is not None else threading.Lock()
+        self.scratch = np.zeros([count, 3], dtype=np.float32) if blend == "alpha" else None
+        # Preallocated result of the unchanged frame check
+        self.mask = np.zeros([count, 3], dtype=bool)
+        self.ready = False
+        self.generation = 0
+        self.compositor = compositor
+        self.shm = None
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def set(self, value):
+        if self.shm is not None:
+            return self.publish(value)
+        if self.ready and self.__unchanged(self.latest, value):
+            return
+        np.copyto(self.back, value, casting='unsafe')
+        with self.lock:
+            self.back, self.middle = self.middle, self.back
+            self.latest = self.middle
+            # A whole frame, flip() can exchange it again
+            self.partial = False
+            self.fresh = True
+        self.ready = True
+        self.touch()
+
+    def __unchanged(self, current, value):
+        # Compare without allocating, np.array_equal builds a new mask on
+        # every frame
+        np.equal(current, value, out=self.mask)
+        return self.mask.all()
+
+    def write(self, pos, value):
+        """Change part of the layer, on top of the last frame written."""
+        with self.lock:
+            if self.middle is not self.latest:
+                np.copyto(self.middle, self.latest)
+            self.partial = True
+            self.middle[pos] = value
+            self.latest = self.middle
+            self.fresh = True
+        self.touch()
+
+    def flip(self):
+        """Make the last frame written the front buffer. Called by the
+        compositor only; return the time spent waiting for the lock."""
+        if not self.fresh:
+            return 0.0
+        wait = 0.0
+        if not self.lock.acquire(False):
+            start = time.perf_counter()
+            self.lock.acquire()
+            wait = time.perf_counter() - start
+        try:
+            if self.partial:
+                np.copyto(self.buffer, self.middle)
+                self.partial = False
+            else:
+                self.buffer, self.middle = self.middle, self.buffer
+            self.fresh = False
+        finally:
+            self.lock.release()
+        return wait
+
+    def touch(self):
+        if self.compositor is not None:
+            self.compositor.changed(self)
+        else:
+            self.generation += 1
+
+    def share(self):
+        """Back the layer with shared memory, so a worker process forked after
+        this call can publish frames that the compositor picks up with poll().
+        """
+        if self.shm is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=8 + self.buffer.nbytes)
+            self.seq = np.ndarray((1,), dtype=np.uint64, buffer=self.shm.buf)
+            self.shared = np.ndarray(self.buffer.shape, dtype=np.float32, buffer=self.shm.buf, offset=8)
+            self.seq[0] = 0
+            self.seen = 0
+
+    def unshare(self):
+        if self.shm is not None:
+            self.poll()
+            del self.seq, self.shared
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def publish(self, value):
+        # Sequence lock: odd while the writer is copying, even when stable
+        if self.seq[0] != 0 and self.__unchanged(self.shared, value):
+            return
+        self.seq[0] += 1
+        np.copyto(self.shared, value, casting='unsafe')
+        self.seq[0] += 1
+
+    def poll(self):
+        """Copy the last frame published by the worker, if any, into buffer."""
+        seq = int(self.seq[0])
+        if seq == self.seen or seq & 1:
+            return False
+        np.copyto(self.buffer, self.shared)
+        if int(self.seq[0]) != seq:
+            return False
+        self.seen = seq
+        self.ready = True
+        self.touch()
+        return True
+
+    def blend_into(self, frame):
+        # pos is always a slice, so dst is a view into the frame
+        dst = frame[self.pos]
+        src = self.buffer
+        match self.blend:
+            case "replace":
+                np.copyto(dst, src)
+            case "add":
+                np.add(dst, src, out=dst)
+            case "max":
+                np.maximum(dst, src, out=dst)
+            case "multiply":
+                np.multiply(dst, src, out=dst)
+                np.multiply(dst, 1/255, out=dst)
+            case "alpha":
+                np.subtract(src, dst, out=self.scratch)
+                np.multiply(self.scratch, self.alpha, out=self.scratch)
+                np.add(dst, self.scratch, out=dst)
+
+class Compositor:
+    """Blend an ordered stack of layers over a base layer into one frame.
+    Layers are written from several workers, ``generation_lock`` keeps
+    their generation counts."""
+    def __init__(self, led_count):
+        self.generation = 0
+        self.generation_lock = threading.Lock()
+        self.base = Layer(slice(None), led_count, compositor=self)
+        self.base.ready = True
+        self.frame = np.zeros([led_count, 3], dtype=np.float32)
+        self.rgb = np.zeros([led_count, 3], dtype=np.uint8)
+        self.layers = {}
+        self._stack = []
+        # Time the last composite() waited on writers swapping buffers
+        self.swap_wait = 0.0
+
+    def add(self, owner, pos, order=0, blend="replace", alpha=1.0):
+        count = len(range(*pos.indices(len(self.frame))))
+        layer = Layer(pos, count, order, blend, alpha, self)
+        self.layers[owner] = layer
+        self.__sort()
+        self.changed()
+        return layer
+
+    def remove(self, owner):
+        self.layers.pop(owner, None)
+        self.__sort()
+        self.changed()
+
+    def changed(self, layer=None):
+        """Bump the generation, and the one of layer when it changed."""
+        with self.generation_lock:
+            if layer is not None:
+                layer.generation += 1
+            self.generation += 1
+
+    def get(self, owner):
+        return self.layers.get(owner)
+
+    def poll(self):
+        for layer in self._stack:
+            if layer.shm is not None:
+                layer.poll()
+
+    def __sort(self):
+        # Stable sort keeps activation order for layers with the same order
+        self._stack = sorted(self.layers.values(), key=lambda l: l.order)
+
+    def composite(self):
+        """Blend every ready layer into the frame and return it as uint8 RGB."""
+        wait = self.base.flip()
+        np.copyto(self.frame, self.base.buffer)
+        for layer in self._stack:
+            if layer.ready:
+                wait += layer.flip()
+                layer.blend_into(self.frame)
+        self.swap_wait = wait
+        np.clip(self.frame, 0, 255, out=self.frame)
+        np.copyto(self.rgb, self.frame, casting='unsafe')
+        return self.rgb
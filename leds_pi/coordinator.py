@@ -0,0 +1,224 @@
+import numpy as np
+import queue
+import threading
+import time
+import leds_pi.rpi_ws281x_ext as rpi_ws281x_ext
+import util.logger as logger
+import util.metrics as metrics
+import util.singleton as singleton
+import util.thread_pool as thread_pool
+from util.config import DataClass
+
+class _Frame:
+    # Packed frames of the controllers rendered together, reused by the stage
+    def __init__(self):
+        self.buffers = {}
+        self.controllers = []
+
+    def buffer(self, controller):
+        out = self.buffers.get(controller)
+        if out is None or len(out) != controller.led_count:
+            out = np.zeros(controller.led_count, dtype=np.uint32)
+            self.buffers[controller] = out
+        self.controllers.append(controller)
+        return out
+
+class OutputStage:
+    """Send prepared frames to the driver from a dedicated thread, so the
+    next frames are computed while the current one is on the wire.
+
+    Up to depth frames wait for the wire. A deeper queue absorbs scheduling
+    jitter, but every queued frame adds one frame time of latency. When the
+    queue is full the scheduler waits for a free frame.
+    """
+    def __init__(self, depth=1, pool=None):
+        self.depth = depth
+        # The thread takes the affinity and priority of the render pool
+        self.pool = pool
+        self.free = queue.Queue()
+        for _ in range(depth + 1):
+            self.free.put(_Frame())
+        self.queue = queue.Queue()
+        self.thread = None
+        self.sent = None
+        self.busy_until = 0.0
+        self.wire = metrics.Metrics.histogram("output_wire_seconds", "Measured time from a render to the end of its transfer")
+        self.expected = metrics.Metrics.gauge("output_wire_expected_seconds", "Expected time a frame spends on the wire")
+        self.occupancy = metrics.Metrics.gauge("output_queue_frames", "Frames waiting for the output thread")
+        self.waiting = metrics.Metrics.histogram("output_queue_wait_seconds", "Time the scheduler waited for a free frame")
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.__run, name="output", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def acquire(self):
+        start = time.perf_counter()
+        frame = self.free.get()
+        self.waiting.observe(time.perf_counter() - start)
+        return frame
+
+    def submit(self, frame):
+        self.queue.put(frame)
+        self.occupancy.set(self.queue.qsize())
+
+    def __wait(self):
+        # ws2811_render waits for the previous transfer holding the GIL, so
+        # sleep through it first and only wait for the remainder
+        delay = self.busy_until - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        if self.sent is not None and rpi_ws281x_ext.Ws2811.wait():
+            self.wire.observe(time.perf_counter() - self.sent)
+            self.sent = None
+
+    def __run(self):
+        if self.pool is not None:
+            self.pool.configure_thread()
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                return
+            self.occupancy.set(self.queue.qsize())
+            try:
+                # The wait counts as render time, it is what the wire costs
+                begin = time.perf_counter()
+                self.__wait()
+                for controller in frame.controllers:
+                    controller.strip.set_leds(slice(None), frame.buffers[controller])
+                start = time.perf_counter()
+                frame.controllers[0].strip.show()
+                self.sent = start
+                wire_time = rpi_ws281x_ext.Ws2811.wire_time()
+                self.busy_until = start + wire_time
+                self.expected.set(wire_time)
+                elapsed = time.perf_counter() - begin
+                for controller in frame.controllers:
+                    controller.presented(elapsed)
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                frame.controllers = []
+                self.free.put(frame)
+
+@singleton.Singleton
+class RenderCoordinator:
+    """Render every LedController sharing the ws2811 driver from one task.
+
+    ws2811_render always transmits both channels, so instead of one render
+    per controller the coordinator ticks at the fastest controller rate,
+    prepares the controllers whose own deadline is due and issues a single
+    render when at least one of them has a new frame. With depth > 0 the
+    render runs in an OutputStage.
+    """
+    def __init__(self) -> None:
+        self.enabled = True
+        self.pool = None
+        self.depth = 1
+        self.stage = None
+        self.controllers = {}
+        self.thread = None
+        self.period = 0
+        self.lock = threading.Lock()
+        # Held while a tick runs, the stage is only stopped between ticks
+        self.ticking = threading.Lock()
+        self.renders = metrics.Metrics.counter("coordinator_renders_total", "Renders issued by the render coordinator")
+        self.coalesced = metrics.Metrics.counter("coordinator_coalesced_total",
+                                                 "Controller frames sent by a render issued for another controller")
+
+    def add(self, controller):
+        with self.lock:
+            if controller in self.controllers:
+                return
+            self.controllers[controller] = time.monotonic_ns()
+        self.retime(controller.pool)
+
+    def remove(self, controller):
+        with self.lock:
+            self.controllers.pop(controller, None)
+            empty = len(self.controllers) == 0
+        if not empty:
+            self.retime()
+        elif self.thread is not None:
+            self.thread.stop()
+            self.thread = None
+            # A tick may still run on another worker of the pool
+            with self.ticking:
+                if self.stage is not None:
+                    self.stage.stop()
+                    self.stage = None
+
+    def retime(self, pool=None):
+        """Tick at the rate of the fastest controller."""
+        with self.lock:
+            if len(self.controllers) == 0:
+                return
+            frame_time = min(c.frame_time for c in self.controllers)
+        self.period = int(frame_time * 1e9)
+        if self.thread is None:
+            pool = self.pool if self.pool is not None else pool
+            if self.depth > 0:
+                self.stage = OutputStage(self.depth, pool)
+                self.stage.start()
+            self.thread = thread_pool.TimeThread(self.__tick, frame_time, pool=pool, name="render", blocking=True)
+            self.thread.start()
+        else:
+            self.thread.set_frame_time(frame_time)
+
+    def __tick(self):
+        with self.ticking:
+            self.__render(self.stage)
+
+    def __render(self, stage):
+        now = time.monotonic_ns()
+        with self.lock:
+            controllers = list(self.controllers.items())
+        dirty = []
+        frame = None
+        for controller, deadline in controllers:
+            # Half a tick of slack, so jitter never skips a controller running
+            # at the tick rate
+            if now + self.period // 2 < deadline:
+                continue
+            period = int(controller.frame_time * 1e9)
+            deadline += period
+            if deadline <= now:
+                deadline = now + period
+            with self.lock:
+                if controller in self.controllers:
+                    self.controllers[controller] = deadline
+            rgb = controller.prepare()
+            if rgb is None:
+                continue
+            dirty.append(controller)
+            if stage is None:
+                controller.pack(rgb)
+            else:
+                if frame is None:
+                    frame = stage.acquire()
+                controller.pack(rgb, frame.buffer(controller))
+        if len(dirty) == 0:
+            return
+        self.renders.inc()
+        self.coalesced.inc(len(dirty) - 1)
+        if frame is not None:
+            stage.submit(frame)
+            return
+        start = time.perf_counter()
+        dirty[0].strip.show()
+        elapsed = time.perf_counter() - start
+        for controller in dirty:
+            controller.presented(elapsed)
+
+@DataClass(name="RenderCoordinator")
+def configure_render_coordinator(enable=True, pool=None, depth=1, **kwargs):
+    RenderCoordinator.enabled = enable
+    RenderCoordinator.pool = pool
+    RenderCoordinator.depth = depth
+    return RenderCoordinator
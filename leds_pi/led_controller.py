@@ -1,71 +1,321 @@
 
 import RPi.GPIO as GPIO
 import leds_pi.led_strip as led_strip
-import multiprocessing as mp
+import leds_pi.rpi_ws281x_ext as rpi_ws281x_ext
+import leds_pi.compositor as compositor
+import leds_pi.coordinator as coordinator
+import numbers
+import time
+import util.logger as logger
+import util.metrics as metrics
 import util.thread_pool as thread_pool
 from util.config import DataClass
 
+# What to do when refresh_rate is faster than the wire can carry frames
+RATE_POLICIES = ("warn", "clamp", "auto", "off")
+# Renders averaged before the measured render time adapts the rate
+ADAPT_FRAMES = 60
+
 @DataClass(name="LedController")
 class LedController(led_strip.LedStrip):
-    def __init__(self, refresh_rate, name = "", relay_pin = None, pool=None, **kwargs):
+    """Composite the layers of the effects and send them to the strip.
+
+    A frame of led_count LEDs needs led_count * 24 bits (32 for RGBW) at
+    the gpio frequency, plus the reset time, on the wire. rate_policy
+    decides what happens when refresh_rate asks for more: "warn" keeps the
+    rate and logs, "clamp" lowers it to the wire limit, "auto" always runs
+    at the wire limit and "off" does nothing. With clamp and auto the rate
+    also follows the measured render time, so the scheduler never runs
+    ticks whose frames cannot go out.
+    """
+    def __init__(self, refresh_rate, name = "", relay_pin = None, pool=None, keep_alive=None, recorder=None,
+                 rate_policy="warn", **kwargs):
         super().__init__(**kwargs)
-        self.lock = mp.Lock()
+        if rate_policy not in RATE_POLICIES:
+            raise KeyError(f"Rate policy '{rate_policy}' not found")
+        # Guards the layer stack and the composited frame. Effects never take
+        # it, they write to their layer's back buffer.
+        self.lock = metrics.TimedLock(metrics.Metrics.histogram("controller_lock_wait_seconds",
+                                                                "Time spent waiting for the controller lock", controller=name))
         self.pool = pool
         self.name = name
         self.refresh_rate = refresh_rate
-        self.frame_time = 1/refresh_rate
-        self.thread = thread_pool.TimeThread(self.__run, self.frame_time, pool=self.pool)
+        self.rate_policy = rate_policy
+        self.rate_gauge = metrics.Metrics.gauge("controller_rate_hz", "Frame rate the controller runs at", controller=name)
+        self.max_rate_gauge = metrics.Metrics.gauge("controller_max_rate_hz", "Frame rate the wire can carry", controller=name)
+        self.__set_rate(self.__target_rate())
+        self.measured = None
+        self.measured_frames = 0
+        # The "warn" policy logs once each time the wire saturates
+        self.saturated = False
+        # ws2811_render blocks, on an event loop it runs in the executor
+        self.thread = thread_pool.TimeThread(self.refresh, self.frame_time, pool=self.pool, name=name, blocking=True)
         self.relay_pin = relay_pin
         if self.relay_pin is not None:
             GPIO.setup(self.relay_pin, GPIO.OUT)
-        self.refs = set()
+        self.compositor = compositor.Compositor(self.led_count)
+        self.keep_alive = keep_alive
+        # Rendered by the RenderCoordinator instead of self.thread, set on start
+        self.coordinated = None
+        self.rendered_generation = None
+        # Frames returned by prepare() and frames sent, the output stage
+        # sends them later
+        self.prepared = 0
+        self.sent = 0
+        # Driver generation of the last frame sent, see Ws2811.init
+        self.driver_generation = None
+        self.last_render = 0
+        self.renders = metrics.Metrics.counter("controller_renders_total", "Frames sent to the strip", controller=name)
+        self.skipped = metrics.Metrics.counter("controller_renders_skipped_total", "Ticks skipped because nothing changed", controller=name)
+        self.recorder = recorder
+        if self.recorder is not None:
+            self.recorder.add(self)
+        self.composite_time = metrics.Metrics.histogram("controller_composite_seconds", "Time to composite and convert a frame", controller=name)
+        self.render_time = metrics.Metrics.histogram("controller_render_seconds", "Time spent in ws2811_render", controller=name)
+        self.swap_wait = metrics.Metrics.histogram("controller_swap_wait_seconds",
+                                                   "Time a frame waited on effects swapping layer buffers", controller=name)
+
+    def reconfigure(self, refresh_rate, keep_alive=None, brightness=255, led_count=None, gpio=None, strip_type=None,
+                    rate_policy="warn", **kwargs):
+        """Apply a reloaded definition. Rate, keep alive and brightness change
+        in place. A new strip type re-initializes the driver: this strip is
+        blanked and both controllers send their frame again on their next
+        tick. The led count and gpio are only read at start up."""
+        pin = gpio if gpio is None or isinstance(gpio, numbers.Number) else gpio.pin
+        if isinstance(strip_type, str):
+            strip_type = led_strip.get_strip_type(strip_type)
+        for field, value, current in (("led_count", led_count, self.led_count), ("gpio", pin, self.gpio)):
+            if value is not None and value != current:
+                logger.error("%s: %s changed from %s to %s, restart to apply it", self.name, field, current, value)
+        self.keep_alive = keep_alive
+        retarget = False
+        if strip_type is not None and strip_type != self.strip_type:
+            with self.lock:
+                self.strip_type = strip_type
+                rpi_ws281x_ext.Ws2811.reconfigure_channel(self.channel, strip_type=strip_type)
+            # The wire limit depends on the bits per pixel
+            retarget = True
+        if retarget or refresh_rate != self.refresh_rate or rate_policy != self.rate_policy:
+            if rate_policy not in RATE_POLICIES:
+                raise KeyError(f"Rate policy '{rate_policy}' not found")
+            self.refresh_rate = refresh_rate
+            self.rate_policy = rate_policy
+            self.measured = None
+            self.measured_frames = 0
+            self.saturated = False
+            self.__set_rate(self.__target_rate())
+        if brightness != self.brightness:
+            self.brightness = brightness
+            self.setBrightness(brightness)
+
+    def max_rate(self):
+        """Highest frame rate the wire can carry for this strip."""
+        return 1 / (self.led_count * rpi_ws281x_ext.bits_per_pixel(self.strip_type) / self.freq_hz
+                    + rpi_ws281x_ext.Ws2811.RESET_TIME)
+
+    def __target_rate(self, log=True):
+        max_rate = self.max_rate()
+        self.max_rate_gauge.set(max_rate)
+        if self.rate_policy == "auto":
+            if log:
+                logger.info("%s: running at the wire limit of %.1f Hz", self.name, max_rate)
+            return max_rate
+        if self.refresh_rate <= max_rate or self.rate_policy == "off":
+            return self.refresh_rate
+        if self.rate_policy == "clamp":
+            if log:
+                logger.warning("%s: refresh rate %s Hz clamped to the wire limit of %.1f Hz", self.name, self.refresh_rate, max_rate)
+            return max_rate
+        if log:
+            logger.warning("%s: refresh rate %s Hz is above the wire limit of %.1f Hz for %d leds",
+                           self.name, self.refresh_rate, max_rate, self.led_count)
+        return self.refresh_rate
+
+    def __set_rate(self, rate):
+        self.rate = rate
+        self.frame_time = 1/rate
+        self.rate_gauge.set(rate)
+        thread = getattr(self, 'thread', None)
+        if thread is not None:
+            thread.set_frame_time(self.frame_time)
+        if getattr(self, 'coordinated', None):
+            coordinator.RenderCoordinator.retime()
+
+    def __adapt(self, render_time):
+        # The render time includes waiting for the previous frame to leave
+        # the wire, so it fills the frame time once the wire is saturated.
+        # Below that it says nothing about the limit, the rate is raised back
+        # towards the target in small steps instead.
+        if self.rate_policy == "off":
+            return
+        self.measured = render_time if self.measured is None else self.measured * 0.9 + render_time * 0.1
+        self.measured_frames += 1
+        if self.measured_frames < ADAPT_FRAMES:
+            return
+        self.measured_frames = 0
+        if self.measured > self.frame_time * 0.9:
+            if self.rate_policy == "warn":
+                if not self.saturated:
+                    logger.warning("%s: renders take %.1f ms, %.1f Hz can not be sustained",
+                                   self.name, self.measured * 1e3, self.rate)
+                self.saturated = True
+                return
+            rate = max(1.0, 0.95 / self.measured)
+            if rate < self.rate:
+                logger.warning("%s: renders take %.1f ms, lowering the rate to %.1f Hz", self.name, self.measured * 1e3, rate)
+                self.__set_rate(rate)
+            return
+        # Back below the limit, warn again when it saturates
+        self.saturated = False
+        if self.rate_policy != "warn" and self.measured < self.frame_time * 0.5:
+            rate = min(self.__target_rate(log=False), self.rate * 1.05)
+            if rate > self.rate:
+                logger.info("%s: renders take %.1f ms, raising the rate to %.1f Hz", self.name, self.measured * 1e3, rate)
+                self.__set_rate(rate)
+
+    def layer_ready(self, owner):
+        layer = self.compositor.get(owner)
+        return layer is not None and layer.ready
 
     def deinit(self):
+        """Drop the layers, send a blank frame and stop rendering. The driver
+        keeps running for the other channel."""
+        with self.lock:
+            for owner in list(self.compositor.layers):
+                self.compositor.remove(owner)
+            self.compositor.base.write(slice(None), 0)
+            blank = self.compositor.generation
+        if self.coordinated is None:
+            self.start()
+        # The render task sends the frames prepared before the blank one
+        # first, so the strip stays dark once the blank one is sent
+        deadline = time.monotonic() + 2 * self.frame_time + 0.5
+        while time.monotonic() < deadline:
+            with self.lock:
+                if self.rendered_generation == blank and self.sent >= self.prepared:
+                    break
+            time.sleep(0.005)
+        self.stop()
         if self.relay_pin is not None:
             GPIO.output(self.relay_pin, GPIO.LOW)
-        super().deinit()
 
-    def __run(self):
-        with self.lock:
+    def refresh(self):
+        frame = self.prepare()
+        if frame is not None:
+            self.pack(frame)
+            start = time.perf_counter()
             led_strip.LedStrip.show(self)
+            self.presented(time.perf_counter() - start)
+
+    def prepare(self):
+        """Composite the layers and return the uint8 RGB frame, or None when
+        there is no new frame to send."""
+        with self.lock:
+            # The driver is brought up once every strip is configured
+            if not self.strip.ready:
+                return None
+            start = time.perf_counter()
+            self.compositor.poll()
+            generation = self.compositor.generation
+            driver_generation = rpi_ws281x_ext.Ws2811.generation
+            if generation == self.rendered_generation and driver_generation == self.driver_generation and \
+                    (self.keep_alive is None or start - self.last_render < self.keep_alive):
+                self.skipped.inc()
+                return None
+            self.rendered_generation = generation
+            self.driver_generation = driver_generation
+            self.last_render = start
+            self.prepared += 1
+            frame = self.compositor.composite()
+        self.composite_time.observe(time.perf_counter() - start)
+        self.swap_wait.observe(self.compositor.swap_wait)
+        return frame
+
+    def pack(self, frame, out=None):
+        """Pack a frame from prepare() into the driver buffer, or into out.
+        Only the render thread writes the frame, so no lock is needed."""
+        if out is None:
+            led_strip.LedStrip.__setitem__(self, slice(None), frame)
+        else:
+            led_strip.pack_rgb(frame, out)
+
+    def presented(self, render_time):
+        """Account for a frame prepared by prepare() and sent to the strip."""
+        with self.lock:
+            self.sent += 1
+        self.render_time.observe(render_time)
+        self.__adapt(render_time)
+        self.renders.inc()
+        if self.renders.value == 1:
+            uptime = metrics.process_uptime()
+            metrics.Metrics.gauge("controller_first_light_seconds", "Time from process start to the first frame",
+                                  controller=self.name).set(uptime)
+            logger.info("%s: first light %.3fs after start", self.name, uptime)
 
     def start(self):
         if self.relay_pin is not None:
             GPIO.output(self.relay_pin, GPIO.HIGH)
-        self.thread.start()
+        if self.coordinated is None:
+            self.coordinated = coordinator.RenderCoordinator.enabled
+        if self.coordinated:
+            coordinator.RenderCoordinator.add(self)
+        else:
+            self.thread.start()
 
     def stop(self):
-        self.thread.stop()
-    
-    def __getitem__(self, pos):
-        with self.lock:
-            return super().__getitem__(pos)
-    
-    def __setitem__(self, pos, value):        
-        with self.lock:
-            return super().__setitem__(pos, value)
+        if self.coordinated:
+            coordinator.RenderCoordinator.remove(self)
+        else:
+            self.thread.stop()
+        self.coordinated = None
     
+    def __setitem__(self, pos, value):
+        self.compositor.base.write(pos, value)
+
     def __len__(self):
-        with self.lock:
-            return len(self.strip)
-    
+        return self.led_count
+
     def fill(self, value):
-        with self.lock:
-            super().fill(value)
+        self.compositor.base.write(slice(None), value)
     
     def show(self):
         pass
 
     def setBrightness(self, brightness):
-        with self.lock:
-            return super().setBrightness(brightness)
+        self.compositor.base.touch()
+        return super().setBrightness(brightness)
 
-    def activate(self, owner):
-        self.refs.add(owner)
+    def render(self, owner, value, pos=slice(None)):
+        layer = self.compositor.get(owner)
+        if layer is None:
+            layer = self.activate(owner, pos)
+        layer.set(value)
+
+    def activate(self, owner, pos=slice(None)):
+        layer = self.compositor.add(owner, pos,
+                                    order=getattr(owner, 'layer', 0),
+                                    blend=getattr(owner, 'blend', "replace"),
+                                    alpha=getattr(owner, 'alpha', 1.0))
         self.start()
+        return layer
+
+    def share(self, owner):
+        self.compositor.get(owner).share()
+
+    def unshare(self, owner):
+        with self.lock:
+            self.compositor.get(owner).unshare()
 
     def release(self, owner):
-        self.refs.remove(owner)
-        if len(self.refs) == 0:
+        if self.compositor.get(owner) is None:
+            return
+        # Under the lock so the layer never disappears in the middle of a frame
+        with self.lock:
+            layer = self.compositor.get(owner)
+            if layer is not None:
+                layer.unshare()
+            self.compositor.remove(owner)
+            empty = len(self.compositor.layers) == 0
+        if empty:
             self.stop()
 
@@ -5,6 +5,24 @@ from util.config import DataClass
 import numbers
 import numpy as np
 
+def pack_rgb(value, out):
+    """Pack an (n, 3) array of integer RGB values into 24-bit values in out."""
+    np.copyto(out, value[:, 0], casting='unsafe')
+    out <<= 8
+    np.bitwise_or(out, value[:, 1], out=out, casting='unsafe')
+    out <<= 8
+    np.bitwise_or(out, value[:, 2], out=out, casting='unsafe')
+    return out
+
+def unpack_rgb(packed, out=None):
+    """Unpack 24-bit values into an (n, 3) uint8 RGB array."""
+    if out is None:
+        out = np.empty((len(packed), 3), dtype=np.uint8)
+    np.right_shift(packed, 16, out=out[:, 0], casting='unsafe')
+    np.right_shift(packed, 8, out=out[:, 1], casting='unsafe')
+    np.copyto(out[:, 2], packed, casting='unsafe')
+    return out
+
 @DataClass(name="GpioInfo")
 class GpioInfo:
     def __init__(self, pin, freq=800000, dma=10, invert=False, channel=0,  **kwargs):
@@ -34,8 +52,8 @@ class LedStrip:
         self.strip = PixelStrip(self.led_count, self.gpio, self.freq_hz,
                                        self.dma, self.invert, self.brightness,
                                        self.channel, self.strip_type)
-        self.strip.begin()
         self.enabled = True
+        self._packed = np.zeros(self.led_count, dtype=np.uint32)
     
     def deinit(self):
         self.fill((0,0,0))
@@ -54,7 +72,7 @@ class LedStrip:
 
     def __getitem__(self, pos):
         if isinstance(pos, slice):
-            return [((item >> 16) & 0xff, (item >> 8) & 0xff, item & 0xff) for item in self.strip.__getitem__(pos)]
+            return unpack_rgb(self.strip.get_leds(pos))
         else:
             item = self.strip.__getitem__(pos)
             return ((item >> 16) & 0xff, (item >> 8) & 0xff, item & 0xff)
@@ -64,12 +82,11 @@ class LedStrip:
         positions.
         """
         if isinstance(pos, slice):
-            value = np.left_shift(value, (16,8,0))
-            value = np.sum(value,1)
-            v = 0
-            for n in range(*pos.indices(self.strip.size)):
-                ws.ws2811_led_set(self.strip._channel, n, int(value[v]))
-                v += 1
+            value = np.asarray(value)
+            count = len(range(*pos.indices(self.strip.size)))
+            if value.ndim == 1:
+                value = np.broadcast_to(value, (count, 3))
+            self.strip.set_leds(pos, pack_rgb(value[:count], self._packed[:count]))
         # Else assume the passed in value is a number to the position.
         else:
             value = np.left_shift(value, (16,8,0))
@@ -90,12 +107,25 @@ class LedStrip:
     def setBrightness(self, brightness):
         self.strip.setBrightness(brightness)
 
-    def activate(self, owner):
+    def render(self, owner, value, pos=slice(None)):
+        self[pos] = value
+        self.show()
+
+    def activate(self, owner, pos=slice(None)):
+        pass
+
+    def share(self, owner):
+        raise RuntimeError(f"{type(self).__name__} can not be rendered from a worker process")
+
+    def unshare(self, owner):
         pass
 
     def release(self, owner):
         pass
 
+    def layer_ready(self, owner):
+        return True
+
 @DataClass(name="LedStripSection")
 class LedStripSection:
     def build_slice(self, pos:slice):
@@ -173,12 +203,24 @@ class LedStripSection:
     def setBrightness(self, brightness):
         self.led_strip.setBrightness(brightness)
 
-    def activate(self, owner):
-        self.led_strip.activate(owner)
+    def render(self, owner, value, pos=slice(None)):
+        self.led_strip.render(owner, value, self.build_slice(pos))
+
+    def activate(self, owner, pos=slice(None)):
+        self.led_strip.activate(owner, self.build_slice(pos))
+
+    def share(self, owner):
+        self.led_strip.share(owner)
+
+    def unshare(self, owner):
+        self.led_strip.unshare(owner)
 
     def release(self, owner):
         self.led_strip.release(owner)
 
+    def layer_ready(self, owner):
+        return self.led_strip.layer_ready(owner)
+
 @DataClass(name="slice")
 def build_slice(v = None, start = None, stop = None, step = None, **kwargs):
     if v is not None:
@@ -82,7 +82,7 @@ class Palette:
         215,218,220,223,225,228,231,233,236,239,241,244,247,249,252,255
     ]
 
-    def __init__(self, colors:str|tuple|list, res = 65536, colors_map=None, color_correction = (255, 255, 255), **kwargs):
+    def __init__(self, colors:str|tuple|list, res = 65536, colors_map=None, color_correction = (255, 255, 255), gamma = False, **kwargs):
         colors = Color.parse_colors(colors)
         if isinstance(colors, (tuple)):
             colors = [(0,0,0), colors]
@@ -93,18 +93,66 @@ class Palette:
             n = len(colors)
             colors_map = np.linspace(0,res,n, endpoint=True)
 
+        self.lut = None
+        self.version = 0
         self.res = res
         self.colors_map = colors_map
-        self.colors = np.array(colors, dtype =np.int16)
-        self.colors_red_val = self.colors[:,0]
-        self.colors_green_val = self.colors[:,1]
-        self.colors_blue_val = self.colors[:,2]
+        self.colors = colors
         self.gama_val = np.array(Palette.GAMMA, dtype = np.int16)
         self.gama_x = np.linspace(0, len(self.gama_val), len(self.gama_val), endpoint=False)
+        self.gamma = gamma
         self.correction = color_correction
+        self.compile()
+
+    @property
+    def colors(self):
+        return self._colors
+
+    @colors.setter
+    def colors(self, colors):
+        self._colors = np.array(colors, dtype =np.int16)
+        self.colors_red_val = self._colors[:,0]
+        self.colors_green_val = self._colors[:,1]
+        self.colors_blue_val = self._colors[:,2]
+        if len(self.colors_map) != len(self._colors):
+            self.colors_map = np.linspace(0,self.res,len(self._colors), endpoint=True)
+        if self.lut is not None:
+            self.compile()
+
+    @property
+    def correction(self):
+        return self._correction
+
+    @correction.setter
+    def correction(self, correction):
+        self._correction = correction
+        if self.lut is not None:
+            self.compile()
+
+    def compile(self):
+        """Build the res + 1 entries lookup table used by lookup(), with the
+        color correction and optional gamma already applied.
+        """
+        lut = self.correct_color(self.interp(np.arange(self.res + 1)))
+        if self.gamma:
+            lut = self.apply_gammas(lut)
+        self.lut = lut.astype(np.uint8)
+        self.version += 1
 
     def set_res(self, res):
-        self.colors_map = np.linspace(0,res,len(self.fp), endpoint=True)
+        self.res = res
+        self.colors_map = np.linspace(0,res,len(self.colors), endpoint=True)
+        self.compile()
+
+    def lookup(self, data, out=None, index=None):
+        """Map heat values to corrected uint8 RGB with a single table lookup.
+        Heat is rounded to the nearest entry. out and index can be
+        preallocated (n, 3) uint8 and (n,) intp buffers.
+        """
+        if index is None:
+            index = np.empty(len(data), dtype=np.intp)
+        np.rint(data, out=index, casting='unsafe')
+        return np.take(self.lut, index, axis=0, out=out, mode='clip')
 
     def interp_ext(self, data):
         val_r = np.interp(data, self.colors_map, self.colors_red_val)
@@ -0,0 +1,127 @@
+import numpy as np
+import struct
+import time
+import util.logger as logger
+import util.thread_pool as thread_pool
+from util.config import DataClass
+
+# File layout, little endian:
+#   header:     magic, header size, frame rate, controller count
+#   controller: led count, name length, utf-8 name      (once per controller)
+#   frames:     uint8 RGB of every controller, in header order, back to back
+MAGIC = b"LEDREC01"
+HEADER = struct.Struct("<8sIfI")
+CONTROLLER = struct.Struct("<IH")
+
+def write_header(file, fps, layout):
+    entries = b"".join(CONTROLLER.pack(count, len(name.encode())) + name.encode() for name, count in layout)
+    file.write(HEADER.pack(MAGIC, HEADER.size + len(entries), fps, len(layout)))
+    file.write(entries)
+
+def read_header(buffer):
+    """Return (header size, fps, [(name, led count), ...]) from a recording."""
+    magic, header_size, fps, count = HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC:
+        raise RuntimeError(f"Invalid recording header {magic}")
+    layout = []
+    offset = HEADER.size
+    for n in range(count):
+        led_count, name_len = CONTROLLER.unpack_from(buffer, offset)
+        offset += CONTROLLER.size
+        layout.append((bytes(buffer[offset:offset + name_len]).decode(), led_count))
+        offset += name_len
+    return header_size, fps, layout
+
+@DataClass(name="FrameRecorder")
+class FrameRecorder:
+    """Record the composited frames of every LedController that references
+    this recorder into one file, at refresh_rate frames per second.
+    """
+    def __init__(self, filename, refresh_rate=30, name="", pool=None, **kwargs):
+        self.filename = filename
+        self.name = name
+        self.refresh_rate = refresh_rate
+        self.controllers = []
+        self.file = None
+        self.thread = thread_pool.TimeThread(self.__record, 1/refresh_rate, pool=pool, name=name, blocking=True)
+
+    def add(self, controller):
+        self.controllers.append(controller)
+
+    def start(self):
+        if self.file is not None or len(self.controllers) == 0:
+            return
+        layout = [(c.name, c.led_count) for c in self.controllers]
+        self.frame = np.zeros(sum(count for _, count in layout) * 3, dtype=np.uint8)
+        self.file = open(self.filename, 'wb')
+        write_header(self.file, self.refresh_rate, layout)
+        logger.info("Recording %s to %s", layout, self.filename)
+        self.thread.start()
+
+    def __record(self):
+        offset = 0
+        for controller in self.controllers:
+            size = controller.led_count * 3
+            with controller.lock:
+                np.copyto(self.frame[offset:offset + size], controller.compositor.rgb.reshape(-1))
+            offset += size
+        self.file.write(self.frame)
+
+    def stop(self):
+        if self.file is not None:
+            self.thread.stop()
+            self.file.close()
+            self.file = None
+
+@DataClass(name="Replay")
+class Replay:
+    """Stream the frames of one recorded controller from a memory-mapped
+    recording into pixels. Used as an effect of an EffectsUpdater; the frame
+    shown is picked from the elapsed time, so the updater rate does not
+    change the playback speed.
+    """
+    def __init__(self, filename, pixels, controller=None, loop=True, layer=0, blend="replace", alpha=1.0, **kwargs):
+        self.layer = layer
+        self.blend = blend
+        self.alpha = alpha
+        self.loop = loop
+        data = np.memmap(filename, dtype=np.uint8, mode='r')
+        header_size, self.fps, layout = read_header(data)
+
+        names = [name for name, _ in layout]
+        index = names.index(controller) if controller is not None else 0
+        offset = sum(count for _, count in layout[:index]) * 3
+        frame_size = sum(count for _, count in layout) * 3
+        self.frames_count = (len(data) - header_size) // frame_size
+        if self.frames_count == 0:
+            raise RuntimeError(f"Recording {filename} has no frames")
+        frames = data[header_size:header_size + self.frames_count * frame_size].reshape(self.frames_count, frame_size)
+
+        self.pixels = pixels
+        self.leds_count = min(len(self.pixels), layout[index][1])
+        self.frames = frames[:, offset:offset + self.leds_count * 3].reshape(self.frames_count, self.leds_count, 3)
+        self.elapsed = 0.0
+        self.last_update = None
+        try:
+            self.pixels.activate(self)
+        except AttributeError as e:
+            logger.error(e)
+
+    def __del__(self):
+        try:
+            self.pixels.release(self)
+        except AttributeError as e:
+            logger.error(e)
+
+    def update(self, dt=None):
+        # Without dt, advance by the time since the previous update
+        now = time.monotonic()
+        if dt is None:
+            dt = 0.0 if self.last_update is None else now - self.last_update
+        self.last_update = now
+        # Small slack so summed frame times land on their frame
+        index = int(self.elapsed * self.fps + 1e-6)
+        self.elapsed += dt
+        if index >= self.frames_count:
+            index = index % self.frames_count if self.loop else self.frames_count - 1
+        self.pixels.render(self, self.frames[index])
@@ -3,11 +3,21 @@
 # Modified tu support multiple GPIO at the same time
 import _rpi_ws281x as ws
 import atexit
+import ctypes
+import numpy as np
+import threading
+import util.logger as logger
 from util.singleton import Singleton
 from util.config import DataClass
 
 @Singleton
 class Ws2811:
+    # Channel fields the driver reads on every render, everything else is
+    # only applied by ws2811_init
+    LIVE_FIELDS = ("brightness", "gamma")
+    # Low time that latches the data at the end of a frame
+    RESET_TIME = 300e-6
+
     class ChannelInfo:
         def __init__(self, num, pin, invert, brightness, gamma, strip_type) -> None:
             self.num = num
@@ -25,7 +35,19 @@ class Ws2811:
         self.dma = None
         self._leds = None
         self.channels = [None, None]
+        self.buffers = [None, None]
+        self.pending = False
+        # Bumped by every ws2811_init, the strips have to be sent again
+        self.generation = 0
+        # A reload may re-initialize the driver while the render thread
+        # sends frames
+        self.lock = threading.RLock()
         self.set_freq_dma()
+
+    @property
+    def ready(self):
+        """True when the driver runs with the current channel configuration."""
+        return self._leds is not None and not self.pending
     
     def set_freq_dma(self, freq_hz=800000, dma=10):
         if self.freq_hz is None and self.dma is None or self._leds is None:
@@ -34,12 +56,22 @@ class Ws2811:
         elif self.freq_hz != freq_hz or self.dma != dma:
             raise RuntimeError(f"Ws2811 already initialized with {self.freq_hz}:{self.dma} {freq_hz}:{dma}")
 
-    def init(self):
+    def init(self, blank=()):
+        """Bring the driver up. When it is running, the LED data of both
+        channels is kept, but for the channels in blank, and sent again
+        right away."""
+        saved = [None, None]
+        running = self._leds is not None
         if self._leds is None:
             self._leds = ws.new_ws2811_t()
             atexit.register(self.__cleanup)
         else:
+            # Keep what both channels show across the re-initialization
+            for channum in range(2):
+                buffer = self.get_buffer(channum)
+                saved[channum] = buffer.copy() if buffer is not None else None
             ws.ws2811_fini(self._leds)
+        self.buffers = [None, None]
 
         # Initialize the controller
         ws.ws2811_t_freq_set(self._leds, self.freq_hz)
@@ -53,6 +85,17 @@ class Ws2811:
         if resp != 0:
             str_resp = ws.ws2811_get_return_t_str(resp)
             raise RuntimeError('ws2811_init failed with code {0} ({1})'.format(resp, str_resp))
+        self.pending = False
+        self.generation += 1
+
+        for channum in range(2):
+            buffer = self.get_buffer(channum)
+            if channum in blank:
+                continue
+            if saved[channum] is not None and buffer is not None and len(buffer) == len(saved[channum]):
+                buffer[:] = saved[channum]
+        if running:
+            self.show()
 
     def __cleanup(self):
         # Clean up memory used by the library when not needed anymore.
@@ -64,6 +107,7 @@ class Ws2811:
             ws.ws2811_fini(self._leds)
             ws.delete_ws2811_t(self._leds)
             self._leds = None
+            self.buffers = [None, None]
 
     def configure_channel(self, num, pin, channel = 0, invert=False, brightness=255, gamma=None, strip_type=None):
         if gamma is None:
@@ -79,9 +123,56 @@ class Ws2811:
             strip_type = ws.WS2811_STRIP_RGB
         
         self.channels[channel] = Ws2811.ChannelInfo(num, pin, invert, brightness, gamma, strip_type)
+        # Applied by the next begin(), once every strip is configured
+        self.pending = True
+
+    def reconfigure_channel(self, channel, **fields):
+        """Change fields of a configured channel. Brightness and gamma are
+        applied to the running driver. Any other field (num, pin, invert,
+        strip_type) can only be applied by ws2811_init, so the driver is
+        re-initialized: the channel restarts blank, the other one is sent
+        again with its LED data. Both stay dark while DMA restarts.
+        """
+        info = self.channels[channel]
+        if info is None:
+            raise KeyError(f"Channel {channel} is not configured")
+        for key, value in fields.items():
+            if not hasattr(info, key):
+                raise KeyError(f"Unknown channel field {key}")
+            setattr(info, key, (1 if value else 0) if key == "invert" else value)
+        if self._leds is None or self.pending:
+            self.pending = True
+        elif all(key in Ws2811.LIVE_FIELDS for key in fields):
+            _channel = ws.ws2811_channel_get(self._leds, channel)
+            if "brightness" in fields:
+                ws.ws2811_channel_t_brightness_set(_channel, info.brightness)
+            if "gamma" in fields:
+                ws.ws2811_channel_t_gamma_set(_channel, info.gamma)
+        else:
+            logger.warning("Ws2811: %s of channel %d changed, re-initializing the driver for both channels",
+                           ", ".join(fields), channel)
+            with self.lock:
+                self.init(blank=(channel,))
 
     def get_channel(self, channel):
         return ws.ws2811_channel_get(self._leds, channel)
+
+    def get_buffer(self, channel):
+        """Return a uint32 numpy view over the LED array of the channel, or
+        None if the binding does not expose the array pointer. The view is
+        invalidated every time the driver is re-initialized.
+        """
+        if self.buffers[channel] is None and self._leds is not None:
+            _channel = self.get_channel(channel)
+            count = ws.ws2811_channel_t_count_get(_channel)
+            try:
+                address = int(ws.ws2811_channel_t_leds_get(_channel))
+            except (AttributeError, TypeError):
+                address = 0
+            if count > 0 and address != 0:
+                ptr = ctypes.cast(address, ctypes.POINTER(ctypes.c_uint32))
+                self.buffers[channel] = np.ctypeslib.as_array(ptr, shape=(count,))
+        return self.buffers[channel]
         
     def __configure_channel(self, channel):
         channel_info = self.channels[channel]
@@ -101,13 +192,37 @@ class Ws2811:
 
     def begin(self):
         """Initialize library, must be called once before other functions are
-        called.
+        called. Does nothing when no channel changed since the last call, so
+        the driver is brought up once after all strips are configured.
         """
-        self.init()
+        with self.lock:
+            if not self.ready:
+                self.init()
     
+    def wire_time(self, channel=None):
+        """Expected seconds a frame spends on the wire, for one channel or
+        for a render. Both channels are sent in parallel, so the longest one
+        counts."""
+        channels = self.channels if channel is None else [self.channels[channel]]
+        bits = max([c.num * bits_per_pixel(c.strip_type) for c in channels if c is not None], default=0)
+        return bits / self.freq_hz + Ws2811.RESET_TIME
+
+    def wait(self):
+        """Block until the last frame left the wire. Return False when the
+        driver is not running."""
+        with self.lock:
+            if self._leds is None:
+                return False
+            resp = ws.ws2811_wait(self._leds)
+        if resp != 0:
+            str_resp = ws.ws2811_get_return_t_str(resp)
+            raise RuntimeError('ws2811_wait failed with code {0} ({1})'.format(resp, str_resp))
+        return True
+
     def show(self):
         """Update the display with the data from the LED buffer."""
-        resp = ws.ws2811_render(self._leds)
+        with self.lock:
+            resp = ws.ws2811_render(self._leds)
         if resp != 0:
             str_resp = ws.ws2811_get_return_t_str(resp)
             raise RuntimeError('ws2811_render failed with code {0} ({1})'.format(resp, str_resp))
@@ -127,11 +242,46 @@ class PixelStrip:
         self._leds = Ws2811()
         self._leds.set_freq_dma(freq_hz, dma)
         self._leds.configure_channel(num, pin, channel, invert, brightness, gamma, strip_type)
-        self._leds.begin()
-
-        self._channel = self._leds.get_channel(channel)
+        self.channel = channel
         self.size = num
 
+    @property
+    def ready(self):
+        return self._leds.ready
+
+    @property
+    def _channel(self):
+        if not self._leds.ready:
+            self._leds.begin()
+        return self._leds.get_channel(self.channel)
+
+    @property
+    def buffer(self):
+        if not self._leds.ready:
+            self._leds.begin()
+        return self._leds.get_buffer(self.channel)
+
+    def set_leds(self, pos, values):
+        """Write packed 24-bit values (a scalar or a uint32 array) to a
+        position or slice of positions with a single numpy assignment.
+        """
+        buffer = self.buffer
+        if buffer is not None:
+            buffer[pos] = values
+        elif isinstance(pos, slice):
+            values = np.broadcast_to(values, (len(range(*pos.indices(self.size))),))
+            for v, n in enumerate(range(*pos.indices(self.size))):
+                ws.ws2811_led_set(self._channel, n, int(values[v]))
+        else:
+            ws.ws2811_led_set(self._channel, pos, int(values))
+
+    def get_leds(self, pos=slice(None)):
+        """Return a uint32 copy of the packed values at a slice of positions."""
+        buffer = self.buffer
+        if buffer is not None:
+            return buffer[pos].copy()
+        return np.array([ws.ws2811_led_get(self._channel, n) for n in range(*pos.indices(self.size))], dtype=np.uint32)
+
     def __getitem__(self, pos):
         """Return the 24-bit RGB color value at the provided position or slice
         of positions.
@@ -139,7 +289,7 @@ class PixelStrip:
         # Handle if a slice of positions are passed in by grabbing all the values
         # and returning them in a list.
         if isinstance(pos, slice):
-            return [ws.ws2811_led_get(self._channel, n) for n in range(*pos.indices(self.size))]
+            return self.get_leds(pos).tolist()
         # Else assume the passed in value is a number to the position.
         else:
             return ws.ws2811_led_get(self._channel, pos)
@@ -151,33 +301,39 @@ class PixelStrip:
         # Handle if a slice of positions are passed in by setting the appropriate
         # LED data values to the provided value.
         if isinstance(pos, slice):
-            for n in range(*pos.indices(self.size)):
-                ws.ws2811_led_set(self._channel, n, value)
+            self.set_leds(pos, value)
         # Else assume the passed in value is a number to the position.
         else:
             return ws.ws2811_led_set(self._channel, pos, value)
 
     def __len__(self):
-        return ws.ws2811_channel_t_count_get(self._channel)
+        return self.size
 
     def setGamma(self, gamma):
         if type(gamma) is list and len(gamma) == 256:
-            ws.ws2811_channel_t_gamma_set(self._channel, gamma)
+            self._leds.reconfigure_channel(self.channel, gamma=gamma)
 
     def begin(self):
-        pass
+        self._leds.begin()
 
     def show(self):
         self._leds.show()
 
     def getBrightness(self):
-        return ws.ws2811_channel_t_brightness_get(self._channel)
+        return self._leds.channels[self.channel].brightness
 
     def setBrightness(self, brightness):
         """Scale each LED in the buffer by the provided brightness.  A brightness
         of 0 is the darkest and 255 is the brightest.
         """
-        ws.ws2811_channel_t_brightness_set(self._channel, brightness)
+        self._leds.reconfigure_channel(self.channel, brightness=brightness)
+
+def bits_per_pixel(strip_type):
+    """Bits sent for each LED, 32 for strips with a white LED. None is the
+    driver default, RGB."""
+    if strip_type is None:
+        strip_type = ws.WS2811_STRIP_RGB
+    return 32 if strip_type & ws.SK6812_SHIFT_WMASK else 24
 
 @DataClass(name="StripType")
 def get_strip_type(strip_type="RGB", **kwargs):
@@ -186,6 +342,8 @@ def get_strip_type(strip_type="RGB", **kwargs):
             return ws.WS2811_STRIP_RGB
         case "GRB":
             return ws.WS2811_STRIP_GRB
+        case "RGBW":
+            return ws.SK6812_STRIP_RGBW
         case _:
             pass
     return ws.WS2811_STRIP_RGB
@@ -0,0 +1,231 @@
+import asyncio
+import numpy as np
+import socket
+import threading
+import util.logger as logger
+import util.metrics as metrics
+import util.thread_pool as thread_pool
+from util.config import DataClass
+
+PROTOCOLS = ("ddp", "e131")
+PORTS = {"ddp": 4048, "e131": 5568}
+# Large enough for any UDP datagram, allocated once per source
+MAX_PACKET = 65536
+
+# DDP: flags, sequence, data type, id, offset (u32 BE), length (u16 BE), data
+DDP_VERSION = 0x40
+DDP_PUSH = 0x01
+DDP_TIMECODE = 0x10
+DDP_HEADER = 10
+
+# E1.31: root, framing and DMP layers, then the start code and the DMX data
+E131_ACN_ID = b"ASC-E1.17\0\0\0"
+E131_TERMINATED = 0x40
+E131_DATA = 126
+
+def ddp_packet(offset, data, push=True, seq=0):
+    """Build a DDP packet carrying RGB data for the byte offset."""
+    data = bytes(data)
+    header = bytes([DDP_VERSION | (DDP_PUSH if push else 0), seq & 0x0f, 0x0b, 1])
+    return header + offset.to_bytes(4, 'big') + len(data).to_bytes(2, 'big') + data
+
+def e131_packet(universe, data, seq=0, priority=100, source="leds_project"):
+    """Build an E1.31 data packet carrying up to 512 DMX channels."""
+    data = bytes(data)
+    packet = bytearray(E131_DATA + len(data))
+    packet[0:2] = (0x0010).to_bytes(2, 'big')
+    packet[4:16] = E131_ACN_ID
+    packet[16:18] = (0x7000 | (len(packet) - 16)).to_bytes(2, 'big')
+    packet[18:22] = (0x00000004).to_bytes(4, 'big')
+    packet[38:40] = (0x7000 | (len(packet) - 38)).to_bytes(2, 'big')
+    packet[40:44] = (0x00000002).to_bytes(4, 'big')
+    packet[44:44 + len(source[:63])] = source[:63].encode()
+    packet[108] = priority
+    packet[111] = seq & 0xff
+    packet[113:115] = universe.to_bytes(2, 'big')
+    packet[115:117] = (0x7000 | (len(packet) - 115)).to_bytes(2, 'big')
+    packet[117] = 0x02
+    packet[118] = 0xa1
+    packet[121:123] = (1).to_bytes(2, 'big')
+    packet[123:125] = (len(data) + 1).to_bytes(2, 'big')
+    packet[E131_DATA:] = data
+    return bytes(packet)
+
+class _Output:
+    # Layer owner for one output, so several outputs can share a controller
+    def __init__(self, pixels, view, layer, blend, alpha):
+        self.pixels = pixels
+        self.view = view
+        self.layer = layer
+        self.blend = blend
+        self.alpha = alpha
+
+@DataClass(name="UdpSource")
+class UdpSource:
+    """Render frames streamed by a show controller as DDP or E1.31 (sACN).
+
+    pixels is one output or a list of outputs laid out back to back: DDP
+    byte offsets, and E1.31 universes of channels_per_universe channels
+    starting at universe, address that layout. Packets are received into
+    one preallocated buffer and copied into the frame, which is rendered
+    once when complete: on the DDP push flag, or once every universe of the
+    frame arrived (or one arrived twice) for E1.31. With port 0 the source
+    binds an ephemeral port, see address. When the pools run on an event
+    loop the socket is read from the loop instead of a thread.
+    """
+    def __init__(self, pixels, protocol="ddp", port=None, host="0.0.0.0", universe=1, channels_per_universe=510,
+                 multicast=False, layer=0, blend="replace", alpha=1.0, name="", **kwargs):
+        if protocol not in PROTOCOLS:
+            raise KeyError(f"Protocol '{protocol}' not found")
+        self.name = name
+        self.protocol = protocol
+        self.port = port if port is not None else PORTS[protocol]
+        self.host = host
+        self.universe = universe
+        self.channels_per_universe = channels_per_universe
+        self.multicast = multicast
+
+        pixels = pixels if isinstance(pixels, list) else [pixels]
+        self.frame = np.zeros(sum(len(p) for p in pixels) * 3, dtype=np.uint8)
+        self.outputs = []
+        offset = 0
+        for p in pixels:
+            count = len(p)
+            view = self.frame[offset:offset + count * 3].reshape(count, 3)
+            self.outputs.append(_Output(p, view, layer, blend, alpha))
+            offset += count * 3
+
+        self.packet = bytearray(MAX_PACKET)
+        self.data = np.frombuffer(self.packet, dtype=np.uint8)
+        self.universes = -(-len(self.frame) // channels_per_universe)
+        self.received = np.zeros(self.universes, dtype=bool)
+        self.pending = 0
+
+        self.packets = metrics.Metrics.counter("udp_packets_total", "Packets received", source=name)
+        self.dropped = metrics.Metrics.counter("udp_packets_dropped_total", "Packets ignored as invalid", source=name)
+        self.frames = metrics.Metrics.counter("udp_frames_total", "Frames rendered", source=name)
+        self.socket = None
+        self.thread = None
+        self.loop = None
+        self.address = None
+        self._stop = False
+
+    def start(self):
+        if self.thread is not None or self.loop is not None:
+            return
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        except OSError as e:
+            logger.error(e)
+        self.socket.bind((self.host, self.port))
+        if self.protocol == "e131" and self.multicast:
+            for universe in range(self.universe, self.universe + self.universes):
+                group = socket.inet_aton(f"239.255.{universe >> 8}.{universe & 0xff}")
+                self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, group + socket.inet_aton(self.host))
+        self.address = self.socket.getsockname()
+        logger.info("Receiving %s on %s for %d leds", self.protocol, self.address, len(self.frame) // 3)
+
+        for output in self.outputs:
+            output.pixels.activate(output)
+        self._stop = False
+        self.loop = thread_pool.get_loop()
+        if self.loop is not None:
+            self.socket.setblocking(False)
+            self.loop.call_soon_threadsafe(self.loop.add_reader, self.socket.fileno(), self.__readable, self.socket)
+        else:
+            # Wake up regularly to notice stop()
+            self.socket.settimeout(0.5)
+            self.thread = threading.Thread(target=self.__run, name=self.name, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is None and self.loop is None:
+            return
+        self._stop = True
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.__close, self.socket)
+            self.loop = None
+        else:
+            self.thread.join()
+            self.thread = None
+            self.socket.close()
+        self.socket = None
+        for output in self.outputs:
+            output.pixels.release(output)
+
+    def __close(self, sock):
+        asyncio.get_running_loop().remove_reader(sock.fileno())
+        sock.close()
+
+    def __readable(self, sock):
+        # Drain what is queued without blocking the loop
+        handle = self.__ddp if self.protocol == "ddp" else self.__e131
+        while True:
+            try:
+                size = sock.recv_into(self.packet)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logger.error(e)
+                return
+            self.packets.inc()
+            handle(size)
+
+    def __run(self):
+        handle = self.__ddp if self.protocol == "ddp" else self.__e131
+        while not self._stop:
+            try:
+                size = self.socket.recv_into(self.packet)
+            except socket.timeout:
+                continue
+            except OSError as e:
+                logger.error(e)
+                break
+            self.packets.inc()
+            handle(size)
+
+    def __ddp(self, size):
+        p = self.packet
+        if size < DDP_HEADER or p[0] & 0xc0 != DDP_VERSION:
+            self.dropped.inc()
+            return
+        start = DDP_HEADER + (4 if p[0] & DDP_TIMECODE else 0)
+        offset = (p[4] << 24) | (p[5] << 16) | (p[6] << 8) | p[7]
+        length = min((p[8] << 8) | p[9], size - start, len(self.frame) - offset)
+        if length > 0:
+            self.frame[offset:offset + length] = self.data[start:start + length]
+        if p[0] & DDP_PUSH:
+            self.__render()
+
+    def __e131(self, size):
+        p = self.packet
+        # Root vector 4 (data), framing vector 2 (DMP), DMP vector 2, start code 0
+        if size < E131_DATA or p[21] != 0x04 or p[43] != 0x02 or p[117] != 0x02 or p[125] != 0:
+            self.dropped.inc()
+            return
+        if p[112] & E131_TERMINATED:
+            return
+        index = ((p[113] << 8) | p[114]) - self.universe
+        if index < 0 or index >= self.universes:
+            return
+        if self.received[index]:
+            # The sender started a new frame before completing this one
+            self.__render()
+        offset = index * self.channels_per_universe
+        length = min(((p[123] << 8) | p[124]) - 1, size - E131_DATA,
+                     self.channels_per_universe, len(self.frame) - offset)
+        if length > 0:
+            self.frame[offset:offset + length] = self.data[E131_DATA:E131_DATA + length]
+        self.received[index] = True
+        self.pending += 1
+        if self.pending == self.universes:
+            self.__render()
+
+    def __render(self):
+        for output in self.outputs:
+            output.pixels.render(output, output.view)
+        self.received[:] = False
+        self.pending = 0
+        self.frames.inc()
@@ -0,0 +1,34 @@
+"""The tests run against the stand-ins of benchmarks/stubs.py, so they do not
+need a Raspberry Pi."""
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks import stubs
+stubs.install()
+import numpy as np
+import pytest
+
+class Pixels:
+    """Stands in for a LedController, keeps every frame rendered."""
+    def __init__(self, count):
+        self.count = count
+        self.frames = []
+
+    def __len__(self):
+        return self.count
+
+    def activate(self, owner):
+        pass
+
+    def release(self, owner):
+        pass
+
+    def layer_ready(self, owner):
+        return len(self.frames) > 0
+
+    def render(self, owner, value):
+        self.frames.append(np.array(value))
+
+@pytest.fixture
+def make_pixels():
+    return Pixels
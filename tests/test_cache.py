@@ -0,0 +1,92 @@
+import threading
+import numpy as np
+import effects.cache as cache
+
+class Cache:
+    def __init__(self, name):
+        self.name = name
+        self.frames = None
+
+    def evict(self):
+        self.frames = None
+
+def test_frame_cache_accounting_across_threads():
+    frame_cache = cache.FrameCache
+    max_bytes = frame_cache.max_bytes
+    frame_cache.max_bytes = 10 * 1024
+    try:
+        def worker(n):
+            for i in range(500):
+                entry = Cache(f"cache_{n}_{i}")
+                frames = np.zeros(1024, dtype=np.uint8)
+                if frame_cache.reserve(entry, frames.nbytes):
+                    entry.frames = frames
+                    frame_cache.touch(entry)
+                if i % 3 == 0 and entry.frames is not None:
+                    frame_cache.release(entry, frames.nbytes)
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        with frame_cache.lock:
+            assert frame_cache.used <= frame_cache.max_bytes
+            assert frame_cache.used == 1024 * len(frame_cache._entries)
+    finally:
+        frame_cache.max_bytes = max_bytes
+        for entry, size in list(frame_cache._entries.values()):
+            frame_cache.release(entry, size)
+
+class Periodic:
+    """Cycles through period states, its frame is the state."""
+    name = "periodic"
+    frame_time = 0.01
+
+    def __init__(self, period, pixels):
+        self.period = period
+        self.state = 0
+        self.pixels = pixels
+
+    def cache_key(self):
+        return self.period
+
+    def cycle_period(self):
+        return None
+
+    def cycle_state(self):
+        return bytes([self.state])
+
+    def frame(self):
+        return np.full((2, 3), self.state, dtype=np.uint8)
+
+def test_cycle_found_when_a_state_repeats(make_pixels):
+    effect = Periodic(3, make_pixels(2))
+    cycle = cache.CycleCache(effect)
+    assert not cycle.play(effect.frame_time)
+    for _ in range(4):
+        cycle.record(effect.frame())
+        effect.state = (effect.state + 1) % effect.period
+    assert len(cycle.frames) == 3
+    # Playback continues after the frame rendered last
+    for _ in range(4):
+        assert cycle.play(effect.frame_time)
+    assert [int(f[0, 0]) for f in effect.pixels.frames] == [1, 2, 0, 1]
+    # A late tick skips the frames it missed
+    assert cycle.play(3 * effect.frame_time)
+    assert cycle.play(effect.frame_time)
+    assert [int(f[0, 0]) for f in effect.pixels.frames[4:]] == [2, 2]
+    cycle.reset(None)
+
+def test_seen_states_kept_by_digest(make_pixels, monkeypatch):
+    effect = Periodic(3, make_pixels(2))
+    effect.cycle_state = lambda: (effect.state, bytes(4096))
+    cycle = cache.CycleCache(effect)
+    cycle.record(effect.frame())
+    assert [len(key) for key in cycle.seen] == [16]
+    # A digest collision is caught by comparing the frames
+    monkeypatch.setattr(cache, "_digest", lambda state: b"same")
+    cycle = cache.CycleCache(effect)
+    for _ in range(6):
+        cycle.record(effect.frame())
+        effect.state = (effect.state + 1) % effect.period
+    assert cycle.frames is None and len(cycle.recorded) == 6
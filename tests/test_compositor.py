@@ -0,0 +1,86 @@
+import threading
+import numpy as np
+import pytest
+import leds_pi.compositor as compositor
+
+def composite(blend, base, value, alpha=1.0):
+    stack = compositor.Compositor(2)
+    stack.base.set(np.array(base, dtype=np.uint8))
+    stack.add("owner", slice(None), blend=blend, alpha=alpha).set(np.array(value, dtype=np.uint8))
+    return stack.composite().tolist()
+
+def test_replace():
+    assert composite("replace", [[10, 20, 30], [40, 50, 60]], [[1, 2, 3], [4, 5, 6]]) == [[1, 2, 3], [4, 5, 6]]
+
+def test_add_saturates():
+    assert composite("add", [[10, 200, 0], [0, 0, 0]], [[10, 100, 0], [1, 2, 3]]) == [[20, 255, 0], [1, 2, 3]]
+
+def test_max():
+    assert composite("max", [[10, 200, 0], [5, 5, 5]], [[20, 100, 0], [1, 9, 3]]) == [[20, 200, 0], [5, 9, 5]]
+
+def test_multiply():
+    assert composite("multiply", [[255, 100, 0], [51, 51, 51]], [[255, 255, 255], [0, 255, 128]]) == [[255, 100, 0], [0, 51, 25]]
+
+def test_alpha():
+    assert composite("alpha", [[0, 100, 200], [0, 0, 0]], [[200, 100, 0], [10, 20, 30]], alpha=0.5) == [[100, 100, 100], [5, 10, 15]]
+    assert composite("alpha", [[0, 100, 200], [0, 0, 0]], [[200, 100, 0], [10, 20, 30]], alpha=0.0) == [[0, 100, 200], [0, 0, 0]]
+
+def test_layer_order_and_section():
+    stack = compositor.Compositor(4)
+    # Added first, blended last
+    stack.add("top", slice(1, 3), order=1).set(np.full((2, 3), 9, dtype=np.uint8))
+    stack.add("bottom", slice(0, 4), order=0).set(np.full((4, 3), 1, dtype=np.uint8))
+    assert stack.composite()[:, 0].tolist() == [1, 9, 9, 1]
+
+def test_layer_not_ready_is_skipped():
+    stack = compositor.Compositor(2)
+    stack.base.set(np.full((2, 3), 7, dtype=np.uint8))
+    stack.add("owner", slice(None))
+    assert (stack.composite() == 7).all()
+    stack.remove("owner")
+    assert (stack.composite() == 7).all()
+
+def test_unknown_blend():
+    with pytest.raises(KeyError):
+        compositor.Compositor(2).add("owner", slice(None), blend="screen")
+
+def test_set_skips_unchanged_frames():
+    stack = compositor.Compositor(4)
+    layer = stack.add("owner", slice(None))
+    frame = np.full((4, 3), 10, dtype=np.uint8)
+    layer.set(frame)
+    generation = stack.generation
+    layer.set(frame.copy())
+    assert stack.generation == generation
+    frame[2] = 20
+    layer.set(frame)
+    assert stack.generation == generation + 1
+    assert np.array_equal(stack.composite(), frame)
+
+def test_generation_counts_writes_of_every_thread():
+    stack = compositor.Compositor(4)
+    layers = [stack.add(n, slice(n, n + 1)) for n in range(4)]
+    generation = stack.generation
+    def write(layer):
+        for value in range(1000):
+            layer.write(slice(None), value % 255)
+    threads = [threading.Thread(target=write, args=(layer,)) for layer in layers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert stack.generation == generation + 4000
+    assert [layer.generation for layer in layers] == [1000] * 4
+
+def test_partial_write_consumed_by_one_flip():
+    stack = compositor.Compositor(4)
+    layer = stack.base
+    layer.write(slice(0, 2), 10)
+    assert layer.partial
+    assert stack.composite()[:2].tolist() == [[10] * 3] * 2
+    assert not layer.partial
+    # Whole frames are exchanged again, not copied
+    layer.set(np.full((4, 3), 20, dtype=np.uint8))
+    middle = layer.middle
+    assert (stack.composite() == 20).all()
+    assert layer.buffer is middle
@@ -0,0 +1,63 @@
+import json
+import logging
+import os
+import sys
+import util.config as config
+
+PROBE = '''from util.config import DataClass
+
+@DataClass(name="PlanProbe")
+class PlanProbe:
+    def __init__(self, value=0, **kwargs):
+        self.value = value
+'''
+
+def test_plan_cache(tmp_path, monkeypatch, caplog):
+    caplog.set_level(logging.DEBUG, logger="led_conn")
+    (tmp_path / "plan_probe.py").write_text(PROBE)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    filename = tmp_path / "config.json"
+    filename.write_text(json.dumps({"config": [
+        {"imports": ["@import:plan_probe"]},
+        {"class": "PlanProbe", "name": "probe", "value": 1},
+    ]}))
+    cache_dir = tmp_path / "cache"
+    compiled = []
+    compile = config.Config.compile
+    monkeypatch.setattr(config.Config, "compile", lambda json_obj: compiled.append(1) or compile(json_obj))
+
+    config.Config.load_cached(str(filename), str(cache_dir), reset_refs=True)
+    assert config.Config.get_instance("probe").value == 1
+    assert len(compiled) == 1 and len(os.listdir(cache_dir)) == 1
+    # Same file and sources, the plan is reused
+    config.Config.load_cached(str(filename), str(cache_dir), reset_refs=True)
+    assert len(compiled) == 1
+    # A source module changed
+    stat = os.stat(sys.modules["plan_probe"].__file__)
+    os.utime(sys.modules["plan_probe"].__file__, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    config.Config.load_cached(str(filename), str(cache_dir), reset_refs=True)
+    assert len(compiled) == 2
+    assert "is stale" in caplog.text
+    # The config changed
+    filename.write_text(filename.read_text().replace('"value": 1', '"value": 2'))
+    config.Config.load_cached(str(filename), str(cache_dir), reset_refs=True)
+    assert len(compiled) == 3
+    assert config.Config.get_instance("probe").value == 2
+    config.Config.reset_refs()
+
+def test_plan_cache_dir_not_writable(tmp_path, monkeypatch, caplog):
+    caplog.set_level(logging.DEBUG, logger="led_conn")
+    (tmp_path / "plan_probe.py").write_text(PROBE)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    filename = tmp_path / "config.json"
+    filename.write_text(json.dumps({"config": [
+        {"imports": ["@import:plan_probe"]},
+        {"class": "PlanProbe", "name": "probe", "value": 3},
+    ]}))
+    # A file where the directory should be, so even root can not write it
+    cache_dir = tmp_path / "cache"
+    cache_dir.write_text("")
+    config.Config.load_cached(str(filename), str(cache_dir), reset_refs=True)
+    assert config.Config.get_instance("probe").value == 3
+    assert "Can not store plan" in caplog.text
+    config.Config.reset_refs()
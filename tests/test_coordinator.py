@@ -0,0 +1,100 @@
+import threading
+import time
+import numpy as np
+import leds_pi.coordinator as coordinator
+import leds_pi.led_controller as led_controller
+import leds_pi.led_strip as led_strip
+import leds_pi.rpi_ws281x_ext as rpi_ws281x_ext
+import util.thread_pool as thread_pool
+
+class Owner:
+    pass
+
+def test_one_submit_per_coordinated_frame():
+    fast = led_controller.LedController(refresh_rate=60, name="test_coordinator_fast", gpio=12, led_count=90)
+    slow = led_controller.LedController(refresh_rate=20, name="test_coordinator_slow", gpio=13, led_count=30)
+    rpi_ws281x_ext.Ws2811.begin()
+    # Several effects on one controller, each with its own layer
+    sections = [led_strip.LedStripSection(fast, [n * 30, (n + 1) * 30, 1]) for n in range(3)]
+    owners = [Owner() for _ in sections]
+    slow_owner = Owner()
+
+    driver = rpi_ws281x_ext.Ws2811._leds
+    submits = driver.renders
+    renders = coordinator.RenderCoordinator.renders.value
+    coalesced = coordinator.RenderCoordinator.coalesced.value
+    try:
+        for n in range(90):
+            for section, owner in zip(sections, owners):
+                section.render(owner, np.full((30, 3), n % 255, dtype=np.uint8))
+            slow.render(slow_owner, np.full((30, 3), n % 255, dtype=np.uint8))
+            time.sleep(1/180)
+    finally:
+        for section, owner in zip(sections, owners):
+            section.release(owner)
+        slow.release(slow_owner)
+
+    submits = driver.renders - submits
+    renders = coordinator.RenderCoordinator.renders.value - renders
+    coalesced = coordinator.RenderCoordinator.coalesced.value - coalesced
+    assert fast.coordinated is None and slow.coordinated is None
+    assert submits > 0
+    # Every coordinated frame is one ws2811_render, whatever the number of
+    # layers and controllers it carries
+    assert submits == renders
+    assert submits == fast.renders.value + slow.renders.value - coalesced
+    assert coalesced > 0
+
+class Blocking:
+    """Controller whose prepare() blocks until released."""
+    frame_time = 0.01
+    pool = None
+    led_count = 4
+
+    def __init__(self):
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        self.strip = self
+
+    def prepare(self):
+        self.entered.set()
+        self.release.wait(2)
+        return np.zeros((4, 3), dtype=np.uint8)
+
+    def pack(self, rgb, out=None):
+        pass
+
+    def set_leds(self, pos, values):
+        pass
+
+    def show(self):
+        pass
+
+    def presented(self, render_time):
+        pass
+
+def test_remove_stops_the_stage_after_the_running_tick():
+    render = coordinator.RenderCoordinator
+    pool = thread_pool.ThreadPool(workers=2, name="test_coordinator_remove")
+    # Another task keeps the workers of the pool running
+    pool.start(lambda: None, 0.01)
+    render.pool = pool
+    controller = Blocking()
+    try:
+        render.add(controller)
+        stage = render.stage
+        assert controller.entered.wait(2)
+        remover = threading.Thread(target=render.remove, args=(controller,))
+        remover.start()
+        remover.join(0.1)
+        # The tick still runs with the stage
+        assert remover.is_alive() and stage.thread is not None
+        controller.release.set()
+        remover.join(2)
+        assert not remover.is_alive()
+        assert render.stage is None and stage.thread is None
+    finally:
+        controller.release.set()
+        render.remove(controller)
+        render.pool = None
+        pool.stop_all()
@@ -0,0 +1,73 @@
+import numpy as np
+import effects.batch as batch
+import effects.heat as heat
+import leds_pi.palette as palette
+
+def run(effect, count):
+    for _ in range(count):
+        effect.update()
+    return np.stack(effect.pixels.frames)
+
+def sparks(make_pixels, seed):
+    return heat.Sparks(pixels=make_pixels(50), palette=palette.Palette([(0, 0, 0), (255, 0, 0)], res=32),
+                       sparks=180, cold_down=-60, seed=seed)
+
+def test_sparks_seed_is_deterministic(make_pixels):
+    frames = run(sparks(make_pixels, 7), 30)
+    assert np.array_equal(frames, run(sparks(make_pixels, 7), 30))
+    assert not np.array_equal(frames, run(sparks(make_pixels, 8), 30))
+
+def test_roll_matches_np_roll(make_pixels):
+    pal = palette.Palette([(0, 0, 0), (0, 0, 255)], res=32)
+    # One led per frame, the heat of the entering led grows by 3 per frame
+    roll = heat.Roll(pixels=make_pixels(10), palette=pal, speed=3 * 60, step_rate=60)
+    frames = run(roll, 25)
+    # The previous implementation rolled the whole heat array every frame
+    expected = np.zeros(10, dtype=np.float32)
+    current = 0
+    for frame in frames:
+        assert np.array_equal(frame, pal.lookup(expected.copy()))
+        current += 3
+        if current > 32:
+            current = 0
+        expected = np.roll(expected, 1)
+        expected[0] = current
+
+def reference_step(batch, rng, cold_down_val, sparks_val, heat, dt):
+    """The step SparksBatch had before it used scratch arrays."""
+    cold_down_val += batch.cold_down * dt
+    cool = (cold_down_val > 1) | (cold_down_val < -1)
+    heat += np.take(np.where(cool, cold_down_val, 0), batch.segment).astype(np.float32)
+    cold_down_val[cool] = 0
+    sparks_val += batch.sparks * dt
+    sparks = sparks_val.astype(np.intp)
+    total = int(sparks.sum())
+    if total > 0:
+        segment = np.repeat(np.arange(len(batch.sims)), sparks)
+        positions = batch.offsets[segment] + (rng.random(total) * batch.counts[segment]).astype(np.intp)
+        heat[positions] = batch.spark[segment]
+        sparks_val -= sparks
+
+def test_sparks_batch_matches_the_allocating_step(make_pixels):
+    pal = palette.Palette([(0, 0, 0), (255, 0, 0)], res=64)
+    sims = [heat.Sparks(pixels=make_pixels(n), palette=pal, sparks=rate, cold_down=-30, seed=5)
+            for n, rate in ((20, 120), (35, 600), (10, 0))]
+    engine = batch.SparksBatch(sims)
+    # The reference consumes the numbers the batch drew
+    drawn = []
+    draw = engine.draw
+    engine.draw = lambda count: drawn.append(draw(count).copy()) or drawn[-1]
+    class Rng:
+        def random(self, total):
+            assert len(drawn[-1]) == total
+            return drawn[-1]
+    rng = Rng()
+    cold_down_val = engine.cold_down_val.copy()
+    sparks_val = engine.sparks_val.copy()
+    expected = engine.heat.copy()
+    buffers = (engine.uniform, engine.positions, engine.scratch)
+    for _ in range(100):
+        engine.step(1 / 60)
+        reference_step(engine, rng, cold_down_val, sparks_val, expected, 1 / 60)
+        assert np.array_equal(engine.heat, expected)
+    assert all(a is b for a, b in zip(buffers, (engine.uniform, engine.positions, engine.scratch)))
@@ -0,0 +1,57 @@
+import util.governor as governor
+
+class Info:
+    def __init__(self):
+        self.missed = 0
+        self.busy = 0.0
+
+class Pool:
+    workers = 1
+
+class Thread:
+    def __init__(self):
+        self.pool = Pool()
+        self.task = Info()
+
+    def info(self):
+        return self.task
+
+class Updater:
+    def __init__(self, name, priority=0, min_rate=None, refresh_rate=60):
+        self.name = name
+        self.priority = priority
+        self.min_rate = min_rate
+        self.refresh_rate = refresh_rate
+        self.rate = refresh_rate
+        self.cache = False
+        self.thread = Thread()
+
+    def set_rate(self, rate):
+        self.rate = rate
+
+    def cacheable(self):
+        return False
+
+def tick():
+    governor.Governor._Governor__tick()
+
+def test_sheds_lowest_priority_on_missed_deadlines():
+    gov = governor.Governor
+    gov.enabled = True
+    gov.updaters = []
+    gov.samples = {}
+    gov.last = None
+    wash = Updater("wash", priority=0, min_rate=5, refresh_rate=30)
+    feature = Updater("feature", priority=10)
+    gov.updaters = [wash, feature]
+    try:
+        tick()
+        # No pressure, nothing changes
+        tick()
+        assert (wash.rate, feature.rate) == (30, 60)
+        feature.thread.task.missed += 3
+        tick()
+        assert (wash.rate, feature.rate) == (15, 60)
+    finally:
+        gov.updaters = []
+        gov.enabled = False
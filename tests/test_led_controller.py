@@ -0,0 +1,77 @@
+import time
+import numpy as np
+import leds_pi.coordinator as coordinator
+import leds_pi.led_controller as led_controller
+import leds_pi.rpi_ws281x_ext as rpi_ws281x_ext
+
+def test_default_strip_type():
+    controller = led_controller.LedController(refresh_rate=60, name="test_default_strip_type", gpio=12, led_count=10)
+    assert controller.strip_type is None
+    # 10 leds of 24 bits at 800 kHz plus the reset time
+    assert abs(controller.max_rate() - 1 / (10 * 24 / 800000 + rpi_ws281x_ext.Ws2811.RESET_TIME)) < 1e-6
+    assert controller.rate == 60
+
+def test_rgbw_bits():
+    assert rpi_ws281x_ext.bits_per_pixel(None) == 24
+    assert rpi_ws281x_ext.bits_per_pixel(rpi_ws281x_ext.get_strip_type("RGB")) == 24
+    assert rpi_ws281x_ext.bits_per_pixel(rpi_ws281x_ext.get_strip_type("RGBW")) == 32
+
+def test_clamp_policy():
+    controller = led_controller.LedController(refresh_rate=60, name="test_clamp_policy", gpio=12, led_count=2000,
+                                              strip_type="RGB", rate_policy="clamp")
+    assert controller.rate == controller.max_rate() < 60
+
+def test_strip_type_change_presents_both_controllers():
+    first = led_controller.LedController(refresh_rate=60, name="test_reconfigure_first", gpio=12, led_count=4)
+    second = led_controller.LedController(refresh_rate=60, name="test_reconfigure_second", gpio=13, led_count=4)
+    driver = rpi_ws281x_ext.Ws2811
+    driver.begin()
+    for controller in (first, second):
+        # Not started, the test sends the frames itself
+        controller.compositor.add(controller, slice(None)).set(np.full((4, 3), 255, dtype=np.uint8))
+        controller.refresh()
+        assert controller.prepare() is None
+    renders = driver._leds.renders
+
+    first.reconfigure(refresh_rate=60, strip_type="GRB")
+    assert first.strip_type == rpi_ws281x_ext.get_strip_type("GRB")
+    # The driver is re-initialized and sent once: the changed strip blank,
+    # the other one with its frame
+    assert driver._leds.renders == renders + 1
+    assert not first.strip.buffer.any()
+    assert (second.strip.buffer == 0xffffff).all()
+    for controller in (first, second):
+        assert controller.prepare() is not None
+
+def test_deinit_blanks_a_running_controller():
+    controller = led_controller.LedController(refresh_rate=60, name="test_deinit", gpio=12, led_count=4)
+    rpi_ws281x_ext.Ws2811.begin()
+    owner = object()
+    controller.render(owner, np.full((4, 3), 255, dtype=np.uint8))
+    deadline = time.monotonic() + 2
+    while not controller.strip.buffer.any() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    assert controller.strip.buffer.any()
+
+    controller.deinit()
+    assert controller.coordinated is None
+    assert controller not in coordinator.RenderCoordinator.controllers
+    assert len(controller.compositor.layers) == 0
+    assert not controller.strip.buffer.any()
+
+def test_warn_policy_warns_once_per_saturation(monkeypatch):
+    controller = led_controller.LedController(refresh_rate=60, name="test_warn_once", gpio=12, led_count=10)
+    warnings = []
+    monkeypatch.setattr(led_controller.logger, "warning", lambda msg, *args: warnings.append(msg % args))
+    adapt = controller._LedController__adapt
+    for _ in range(5 * led_controller.ADAPT_FRAMES):
+        adapt(controller.frame_time)
+    assert len(warnings) == 1 and "can not be sustained" in warnings[0]
+    assert controller.rate == 60
+    # Once the render time drops back it warns on the next saturation
+    for _ in range(2 * led_controller.ADAPT_FRAMES):
+        adapt(0)
+    assert not controller.saturated
+    for _ in range(5 * led_controller.ADAPT_FRAMES):
+        adapt(controller.frame_time)
+    assert len(warnings) == 2
@@ -0,0 +1,70 @@
+import logging
+import logging.handlers
+import queue
+import util.logger as logger
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def record(msg, lineno=1, level=logging.WARNING):
+    return logging.LogRecord("led_conn", level, "effects.py", lineno, msg, (), None)
+
+def test_rate_limit_per_call_site(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(logger.time, "monotonic", clock)
+    limit = logger.RateLimit(rate=1.0, burst=2)
+    assert [limit.filter(record("a")) for _ in range(4)] == [True, True, False, False]
+    # Other call sites have their own budget
+    assert limit.filter(record("b", lineno=2))
+    clock.now = 1.0
+    passed = record("a")
+    assert limit.filter(passed)
+    assert passed.msg == "a (2 similar messages suppressed)"
+    assert not limit.filter(record("a"))
+
+def test_rate_limit_only_warnings_by_default():
+    limit = logger.RateLimit(rate=1.0, burst=1)
+    assert all(limit.filter(record("started", level=logging.INFO)) for _ in range(10))
+    # Opted in with extra={"ratelimit": True}
+    limited = [record("tick", lineno=2, level=logging.INFO) for _ in range(3)]
+    for r in limited:
+        r.ratelimit = True
+    assert [limit.filter(r) for r in limited] == [True, False, False]
+
+def test_rate_limit_disabled():
+    limit = logger.RateLimit(rate=0)
+    assert all(limit.filter(record("a")) for _ in range(100))
+
+class Records(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((record, self.format(record)))
+
+def test_records_are_formatted_by_the_listener():
+    handler = logger._QueueHandler(queue.SimpleQueue())
+    records = Records()
+    listener = logging.handlers.QueueListener(handler.queue, records)
+    log = logging.getLogger("test_logger_queue")
+    log.propagate = False
+    log.addHandler(handler)
+    try:
+        listener.start()
+        args = {"leds": 300}
+        try:
+            raise RuntimeError("boom")
+        except RuntimeError as e:
+            log.error("%(leds)d leds", args, exc_info=e)
+        listener.stop()
+    finally:
+        log.removeHandler(handler)
+    [(passed, text)] = records.records
+    # The record is handed over as is, not formatted by the caller
+    assert passed.msg == "%(leds)d leds" and passed.args == args
+    assert text.startswith("300 leds") and "RuntimeError: boom" in text
@@ -0,0 +1,24 @@
+import numpy as np
+import leds_pi.palette as palette
+
+def reference(pal, heat):
+    """The path lookup() replaced: interpolate, correct, then gamma."""
+    leds = pal.correct_color(pal.interp(heat))
+    if pal.gamma:
+        leds = pal.apply_gammas(leds)
+    return leds.astype(np.uint8)
+
+def test_lut_matches_interp_and_correct():
+    for gamma in (False, True):
+        pal = palette.Palette([(0, 0, 0), (255, 128, 0), (20, 40, 255)], res=1024,
+                              color_correction=(255, 200, 150), gamma=gamma)
+        heat = np.arange(pal.res + 1, dtype=np.float32)
+        assert np.array_equal(pal.lookup(heat), reference(pal, heat))
+
+def test_lookup_rounds_to_the_nearest_entry():
+    pal = palette.Palette([(0, 0, 0), (255, 255, 255)], res=4096)
+    heat = np.random.default_rng(0).uniform(0, pal.res, 1000).astype(np.float32)
+    # Off by one at most from interpolating the exact heat
+    diff = pal.lookup(heat).astype(np.int16) - reference(pal, heat)
+    assert np.abs(diff).max() <= 1
+    assert np.array_equal(pal.lookup(np.array([2.4, 2.6])), pal.lut[[2, 3]])
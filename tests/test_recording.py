@@ -0,0 +1,27 @@
+import numpy as np
+import led_controler
+import leds_pi.recording as recording
+
+def write_recording(path, fps, frames):
+    with open(path, 'wb') as file:
+        recording.write_header(file, fps, [("A", frames.shape[1])])
+        file.write(frames.tobytes())
+
+def test_replay_advances_by_dt(tmp_path, make_pixels):
+    frames = np.arange(10 * 4 * 3, dtype=np.uint8).reshape(10, 4, 3)
+    write_recording(tmp_path / "rec.bin", 10, frames)
+    pixels = make_pixels(4)
+    replay = recording.Replay(str(tmp_path / "rec.bin"), pixels)
+    for _ in range(12):
+        replay.update(0.1)
+    assert [int(f[0, 0]) for f in pixels.frames] == [int(frames[n % 10, 0, 0]) for n in range(12)]
+
+def test_replay_in_updater(tmp_path, make_pixels):
+    frames = np.zeros((5, 4, 3), dtype=np.uint8)
+    write_recording(tmp_path / "rec.bin", 30, frames)
+    pixels = make_pixels(4)
+    replay = recording.Replay(str(tmp_path / "rec.bin"), pixels)
+    updater = led_controler.EffectsUpdater(enable=True, effects=[replay], name="test_replay_in_updater", refresh_rate=30)
+    updater._run()
+    updater._run()
+    assert len(pixels.frames) == 2
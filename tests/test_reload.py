@@ -0,0 +1,64 @@
+import copy
+import json
+import time
+import led_controler
+import util.config as config
+
+def controller(name, gpio):
+    return {"class": "LedController", "name": name, "refresh_rate": 60, "gpio": gpio,
+            "pool": "@ref:ReloadPool", "led_count": 10}
+
+def updater(name, strip, sparks):
+    return {"class": "EffectsUpdater", "name": name, "enable": True, "refresh_rate": 60, "effects": [
+        {"class": "Sparks", "pixels": "@ref:" + strip, "min_heat": 10, "sparks": sparks,
+         "palette": {"class": "Palette", "colors": [255, 0, 0], "res": 32}}]}
+
+CONFIG = {"config": [
+    {"imports": ["@import:util", "@import:leds_pi", "@import:effects"]},
+    {"class": "ThreadPool", "name": "ReloadPool"},
+    controller("ReloadA", 12),
+    controller("ReloadB", 13),
+    updater("ReloadEffectsA", "ReloadA", 1),
+    updater("ReloadEffectsB", "ReloadB", 1),
+]}
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+def test_reload_rebuilds_changed_entries_and_blanks_removed_controllers(tmp_path):
+    filename = tmp_path / "config.json"
+    filename.write_text(json.dumps(CONFIG))
+    config.Config.reset_refs()
+    leds = led_controler.LedsController()
+    leds.load_config_file(str(filename))
+    for sim in leds.sims:
+        sim.start()
+    before = dict(config.Config.get_refs())
+    removed = before["ReloadB"]
+    try:
+        assert wait_for(lambda: removed.strip.buffer.any())
+
+        changed = copy.deepcopy(CONFIG)
+        changed["config"][4] = updater("ReloadEffectsA", "ReloadA", 2)
+        del changed["config"][5]
+        del changed["config"][3]
+        filename.write_text(json.dumps(changed))
+        leds.reload()
+
+        after = config.Config.get_refs()
+        for name in ("ReloadPool", "ReloadA"):
+            assert after[name] is before[name]
+        assert after["ReloadEffectsA"] is not before["ReloadEffectsA"]
+        assert "ReloadB" not in after and "ReloadEffectsB" not in after
+        assert removed.thread.task_id is None
+        assert len(removed.compositor.layers) == 0
+        assert not removed.strip.buffer.any()
+    finally:
+        for sim in leds.sims:
+            sim.stop()
+        for pool in leds.pools:
+            pool.stop_all()
+        config.Config.reset_refs()
@@ -0,0 +1,186 @@
+import asyncio
+import threading
+import time
+import util.thread_pool as thread_pool
+
+MS = 1000000
+
+class Clock:
+    """Stands in for time.monotonic_ns, the task advances it by its cost."""
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+def task(clock, cost, catch_up="skip", max_burst=4):
+    def func():
+        clock.now += cost
+    info = thread_pool.ThreadPool.TaskInfo(func, 0.010, catch_up, max_burst)
+    info.next_update = 0
+    return info
+
+def run(info, now):
+    """Run one tick, return the next deadline and the deadlines missed."""
+    missed = info.missed
+    next_update = info.run(now)
+    return next_update, info.missed - missed
+
+def test_deadlines_do_not_drift(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(thread_pool.time, "monotonic_ns", clock)
+    info = task(clock, 2 * MS)
+    # Woken late every time, the next deadline still follows the previous one
+    for n in range(1, 6):
+        clock.now += 3 * MS
+        assert run(info, clock.now) == (n * 10 * MS, 0)
+        clock.now = n * 10 * MS
+
+def test_skip_drops_missed_deadlines(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(thread_pool.time, "monotonic_ns", clock)
+    info = task(clock, 35 * MS)
+    assert run(info, clock.now) == (40 * MS, 3)
+
+def test_burst_catches_up(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(thread_pool.time, "monotonic_ns", clock)
+    info = task(clock, 35 * MS, catch_up="burst")
+    # Up to max_burst late ticks run back to back
+    assert run(info, clock.now) == (10 * MS, 0)
+    # Further behind, the rest is skipped
+    info = task(clock, 100 * MS, catch_up="burst")
+    clock.now = 0
+    assert run(info, clock.now) == (70 * MS, 6)
+
+def test_pool_runs_at_the_task_rate():
+    pool = thread_pool.ThreadPool()
+    calls = []
+    done = threading.Event()
+    def func():
+        calls.append(time.monotonic())
+        if len(calls) == 10:
+            done.set()
+    pool.start(func, 0.01)
+    try:
+        assert done.wait(2)
+    finally:
+        pool.stop(func)
+    assert 0.07 < calls[9] - calls[0] < 0.2
+
+def test_pool_on_an_event_loop():
+    async def main():
+        loop = asyncio.get_running_loop()
+        thread_pool.use_loop(loop)
+        try:
+            pool = thread_pool.ThreadPool()
+            threads = {"loop": set(), "blocking": set()}
+            done = asyncio.Event()
+            def on_loop():
+                threads["loop"].add(threading.get_ident())
+                if len(threads["blocking"]) > 0:
+                    loop.call_soon_threadsafe(done.set)
+            def blocking():
+                threads["blocking"].add(threading.get_ident())
+            pool.start(on_loop, 0.005)
+            pool.start(blocking, 0.005, blocking=True)
+            await asyncio.wait_for(done.wait(), 2)
+            pool.stop_all()
+            # The schedule ends with the runner task, no thread was started
+            for _ in range(100):
+                if pool.runner is None:
+                    break
+                await asyncio.sleep(0.01)
+            assert pool.runner is None and pool.threads == []
+            return threads
+        finally:
+            thread_pool.use_loop(None)
+    threads = asyncio.run(main())
+    # Effect updates run on the loop, blocking tasks in the executor
+    assert threads["loop"] == {threading.get_ident()}
+    assert threading.get_ident() not in threads["blocking"]
+
+def test_workers_run_tasks_in_parallel():
+    pool = thread_pool.ThreadPool(workers=3, name="test_workers")
+    lock = threading.Lock()
+    running = {}
+    overlap = []
+    concurrent = [0, 0]
+    threads = set()
+    def make(n):
+        def func():
+            with lock:
+                # A task never runs on two workers at once
+                overlap.append(running.get(n, False))
+                running[n] = True
+                threads.add(threading.current_thread().name)
+                concurrent[0] += 1
+                concurrent[1] = max(concurrent)
+            time.sleep(0.02)
+            with lock:
+                running[n] = False
+                concurrent[0] -= 1
+        return func
+    funcs = [make(n) for n in range(3)]
+    for func in funcs:
+        pool.start(func, 0.02)
+    time.sleep(0.2)
+    pool.stop_all()
+    assert pool.threads == []
+    assert not any(overlap)
+    assert len(threads) == 3
+    # One worker would have run a single task at a time
+    assert concurrent[1] > 1
+
+def test_stop_waits_for_the_running_task():
+    pool = thread_pool.ThreadPool(workers=2, name="test_stop_waits")
+    entered = threading.Event()
+    release = threading.Event()
+    def blocking():
+        entered.set()
+        release.wait(2)
+    def other():
+        pass
+    # other keeps the pool running, stop() does not join the workers
+    pool.start(other, 0.01)
+    pool.start(blocking, 0.01)
+    try:
+        assert entered.wait(2)
+        stopper = threading.Thread(target=pool.stop, args=(blocking,))
+        stopper.start()
+        stopper.join(0.1)
+        assert stopper.is_alive()
+        release.set()
+        stopper.join(2)
+        assert not stopper.is_alive()
+    finally:
+        release.set()
+        pool.stop_all()
+
+def test_task_stops_itself():
+    pool = thread_pool.ThreadPool(workers=2, name="test_stop_itself")
+    calls = []
+    def func():
+        calls.append(1)
+        pool.stop(func)
+    pool.start(lambda: None, 0.01)
+    pool.start(func, 0.01)
+    try:
+        deadline = time.monotonic() + 2
+        while pool.get_task_info(func) is not None and time.monotonic() < deadline:
+            time.sleep(0.005)
+        time.sleep(0.05)
+        assert calls == [1]
+    finally:
+        pool.stop_all()
+
+def test_unnamed_tasks_have_their_own_metrics():
+    def first():
+        pass
+    def second():
+        pass
+    a = thread_pool.ThreadPool.TaskInfo(first, 0.01, name="")
+    b = thread_pool.ThreadPool.TaskInfo(second, 0.01, name="")
+    assert a.name == first.__qualname__ and b.name == second.__qualname__
+    a.missed_total.inc()
+    assert b.missed_total is not a.missed_total
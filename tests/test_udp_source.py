@@ -0,0 +1,74 @@
+import socket
+import time
+import numpy as np
+import leds_pi.udp_source as udp_source
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+def start(make_pixels, protocol, count, **kwargs):
+    pixels = make_pixels(count)
+    source = udp_source.UdpSource(pixels=pixels, protocol=protocol, port=0, host="127.0.0.1",
+                                  name=f"test_{protocol}", **kwargs)
+    source.start()
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    return pixels, source, sender
+
+def test_ddp(make_pixels):
+    count = 1000
+    pixels, source, sender = start(make_pixels, "ddp", count)
+    try:
+        data = np.random.default_rng(0).integers(0, 256, count * 3, dtype=np.uint8).tobytes()
+        offsets = range(0, len(data), 1440)
+        # Without the push flag the data is only stored
+        for offset in offsets[:-1]:
+            sender.sendto(udp_source.ddp_packet(offset, data[offset:offset + 1440], push=False), source.address)
+        assert wait_for(lambda: source.packets.value == len(offsets) - 1)
+        assert source.frames.value == 0 and len(pixels.frames) == 0
+        sender.sendto(udp_source.ddp_packet(offsets[-1], data[offsets[-1]:], push=True), source.address)
+        assert wait_for(lambda: source.frames.value == 1)
+        assert np.array_equal(pixels.frames[-1].reshape(-1), np.frombuffer(data, dtype=np.uint8))
+
+        # Too short for a header
+        sender.sendto(b"\x41\x00", source.address)
+        assert wait_for(lambda: source.dropped.value == 1)
+        assert source.frames.value == 1
+    finally:
+        source.stop()
+        sender.close()
+
+def test_e131(make_pixels):
+    count = 400
+    pixels, source, sender = start(make_pixels, "e131", count, universe=1, channels_per_universe=510)
+    try:
+        assert source.universes == 3
+        data = np.random.default_rng(1).integers(0, 256, count * 3, dtype=np.uint8).tobytes()
+        packets = [udp_source.e131_packet(1 + n, data[offset:offset + 510])
+                   for n, offset in enumerate(range(0, len(data), 510))]
+        for packet in packets:
+            sender.sendto(packet, source.address)
+        assert wait_for(lambda: source.frames.value == 1)
+        assert np.array_equal(pixels.frames[-1].reshape(-1), np.frombuffer(data, dtype=np.uint8))
+
+        # A repeated universe renders the incomplete frame
+        sender.sendto(packets[0], source.address)
+        sender.sendto(packets[0], source.address)
+        assert wait_for(lambda: source.frames.value == 2)
+
+        # Stream terminated packets are ignored, invalid ones dropped
+        terminated = bytearray(packets[1])
+        terminated[112] |= udp_source.E131_TERMINATED
+        sender.sendto(bytes(terminated), source.address)
+        invalid = bytearray(packets[1])
+        invalid[117] = 0x01
+        sender.sendto(bytes(invalid), source.address)
+        assert wait_for(lambda: source.packets.value == 7)
+        assert source.dropped.value == 1
+        assert source.pending == 1
+        assert source.frames.value == 2
+    finally:
+        source.stop()
+        sender.close()
@@ -0,0 +1,34 @@
+import leds_pi.rpi_ws281x_ext as rpi_ws281x_ext
+
+def test_begin_once_for_every_strip():
+    driver = rpi_ws281x_ext.Ws2811
+    rpi_ws281x_ext.PixelStrip(4, 12, channel=0)
+    rpi_ws281x_ext.PixelStrip(4, 13, channel=1)
+    assert not driver.ready
+    driver.begin()
+    generation = driver.generation
+    driver.begin()
+    assert driver.ready and driver.generation == generation
+
+def test_reconfigure_channel_keeps_the_other_channel():
+    driver = rpi_ws281x_ext.Ws2811
+    first = rpi_ws281x_ext.PixelStrip(4, 12, channel=0)
+    second = rpi_ws281x_ext.PixelStrip(4, 13, channel=1)
+    driver.begin()
+    first.set_leds(slice(None), 0xff)
+    second.set_leds(slice(None), 0xffffff)
+    renders = driver._leds.renders
+    generation = driver.generation
+
+    # Applied to the running driver
+    driver.reconfigure_channel(1, brightness=10)
+    assert driver.generation == generation
+    assert driver._leds.channels[1].brightness == 10
+
+    # Needs ws2811_init, sent once right away
+    driver.reconfigure_channel(0, invert=True)
+    assert driver.generation == generation + 1
+    assert driver._leds.renders == renders + 1
+    assert driver._leds.channels[0].invert == 1
+    assert not first.buffer.any()
+    assert (second.buffer == 0xffffff).all()
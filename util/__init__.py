@@ -1,4 +1,2 @@
-import util.config
-import util.logger
-import util.singleton
-import util.thread_pool
+# Submodules are imported on use; "@import:util" loads all of them
+__all__ = ["config", "logger", "metrics", "singleton", "thread_pool", "governor"]
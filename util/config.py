@@ -1,16 +1,38 @@
 from typing import Any
 import util.singleton as singleton
+import hashlib
 import importlib
+import inspect
+import logging
+import os
 import re
 import json
+import sys
+import types
+
+# Bump when the layout of compiled plans changes
+PLAN_VERSION = 1
+
+# util.logger imports this module, log through its logger by name
+log = logging.getLogger('led_conn')
 
 @singleton.Singleton
 class Config:
     def __init__(self) -> None:
         self._class_list = {}
+        self._classes = {}
+        self._parse = True
         self._refs = {}
         self._str_cap = {}
         self._instances = set()
+        # Per named object: canonical definition, objects built for it and
+        # the named objects nested in it, used to diff reloads
+        self._defs = {}
+        self._owned = {}
+        self._nested = {}
+        self._building = []
+        self._reload = None
+        self._changed = set()
 
     def register(self, cls, **kwargs):
         name = kwargs.get('name', cls.__qualname__)
@@ -20,14 +42,14 @@ class Config:
 
         def cls_builder(**kwargs):
             obj = cls(**kwargs)
-            if obj not in self._instances:
-                self._instances.add(obj)
+            self.__own(obj)
             return obj
 
         str_cap = kwargs.get('str_cap')
         if str_cap is not None:
             self._str_cap[name] = (re.compile(str_cap), cls_builder)
         self._class_list[name] = cls_builder
+        self._classes[name] = cls
 
     def load_from_filename(self, filename, reset_refs=False):
         with open(filename, 'r') as file:
@@ -46,6 +68,205 @@ class Config:
             self.reset_refs()
         return self.__porcess_config(json_obj)
 
+    def compile(self, json_obj):
+        """Resolve the imports and string captures of a config and check every
+        class name, reference and constructor arguments without building
+        anything. The returned plan is plain JSON; load_plan() builds it
+        importing only the modules that define the classes it uses."""
+        modules = []
+        tree = self.__compile(json_obj, set(), modules, "config")
+        sources = {}
+        for module in modules:
+            path = getattr(sys.modules[module], '__file__', None)
+            if path is not None:
+                sources[path] = os.stat(path).st_mtime_ns
+        return {"version": PLAN_VERSION, "modules": modules, "sources": sources, "config": tree}
+
+    def load_plan(self, plan, reset_refs=False):
+        if plan.get("version") != PLAN_VERSION:
+            raise RuntimeError(f"Unsupported plan version {plan.get('version')}")
+        for module in plan["modules"]:
+            importlib.import_module(module)
+        if reset_refs:
+            self.reset_refs()
+        # Strings were resolved by compile(), what is left are literals
+        self._parse = False
+        try:
+            return self.__porcess_config(plan["config"])
+        finally:
+            self._parse = True
+
+    def load_cached(self, filename, cache_dir, reset_refs=False):
+        """Load a config file through a plan cached in cache_dir by the hash of
+        the file. The plan is compiled again when the file or one of the
+        modules it uses changes. When cache_dir can not be written the plan
+        is only used for this load."""
+        with open(filename, 'rb') as file:
+            data = file.read()
+        path = os.path.join(cache_dir, hashlib.sha256(data).hexdigest() + ".json")
+        plan = None
+        try:
+            with open(path, 'r') as file:
+                plan = json.load(file)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            log.debug("Ignoring plan %s: %s", path, e)
+        if plan is not None and not self.__plan_valid(plan):
+            log.debug("Plan %s is stale, compiling %s again", path, filename)
+            plan = None
+        if plan is None:
+            plan = self.compile(json.loads(data))
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                with open(path + ".tmp", 'w') as file:
+                    json.dump(plan, file)
+                os.replace(path + ".tmp", path)
+            except OSError as e:
+                log.debug("Can not store plan %s: %s", path, e)
+        return self.load_plan(plan, reset_refs)
+
+    def __plan_valid(self, plan):
+        if plan.get("version") != PLAN_VERSION:
+            return False
+        try:
+            return all(os.stat(path).st_mtime_ns == mtime for path, mtime in plan["sources"].items())
+        except OSError:
+            return False
+
+    def __compile(self, config, names, modules, path):
+        if isinstance(config, str):
+            for cap_name, (exp, _) in self._str_cap.items():
+                found = exp.match(config)
+                if found:
+                    return self.__compile_class(dict(found.groupdict(), **{"class": cap_name}), names, modules, path)
+            return config
+        elif isinstance(config, list):
+            return [self.__compile(n, names, modules, f"{path}[{i}]") for i, n in enumerate(config)]
+        elif isinstance(config, dict):
+            if "class" in config:
+                return self.__compile_class(config, names, modules, path)
+            return {k: self.__compile(v, names, modules, f"{path}.{k}") for k, v in config.items()}
+        return config
+
+    def __compile_class(self, config, names, modules, path):
+        cls_name = config["class"]
+        if cls_name not in self._class_list:
+            raise KeyError(f"Class '{cls_name}' not found at {path}")
+        node = {k: self.__compile(v, names, modules, f"{path}.{k}") for k, v in config.items()}
+        if cls_name == "import":
+            # Only needed to register the classes, the plan lists the modules
+            self._class_list[cls_name](**node)
+            return None
+        if cls_name == "ref":
+            if node.get("name") not in names:
+                raise KeyError(f"Reference '{node.get('name')}' at {path} is not defined before use")
+            return node
+        cls = self._classes[cls_name]
+        try:
+            inspect.signature(cls).bind(**node)
+        except TypeError as e:
+            raise TypeError(f"Invalid arguments for '{cls_name}' at {path}: {e}") from None
+        except ValueError:
+            pass
+        if cls.__module__ != "__main__" and cls.__module__ not in modules:
+            modules.append(cls.__module__)
+        if config.get("name") is not None:
+            names.add(config["name"])
+        return node
+
+    def reload_from_json(self, json_obj):
+        """Load a new version of the config next to the running one.
+
+        Named objects whose definition, and the definitions they reference,
+        did not change are reused as they are. Changed named objects that
+        provide reconfigure(**kwargs) are kept and updated in place; every
+        other changed object is built again. Return (created, stale): the
+        objects built by this load and the objects of the previous load that
+        are not used anymore. Starting and stopping them is up to the caller.
+        """
+        plan = self.compile(json_obj)
+        previous = types.SimpleNamespace(refs=self._refs, defs=self._defs, owned=self._owned,
+                                         nested=self._nested, instances=self._instances)
+        self._refs, self._defs, self._owned, self._nested, self._instances = {}, {}, {}, {}, set()
+        self._reload = previous
+        self._changed = set()
+        self._building = []
+        self._parse = False
+        try:
+            self.__porcess_config(plan["config"])
+        except Exception:
+            self._refs, self._defs, self._owned = previous.refs, previous.defs, previous.owned
+            self._nested, self._instances = previous.nested, previous.instances
+            raise
+        finally:
+            self._reload = None
+            self._parse = True
+        created = [obj for obj in self._instances if obj not in previous.instances]
+        # Modules from @import nodes are not part of compiled configs
+        stale = [obj for obj in previous.instances
+                 if obj not in self._instances and not isinstance(obj, types.ModuleType)]
+        return created, stale
+
+    def __own(self, obj):
+        self._instances.add(obj)
+        for objs, _ in self._building:
+            objs.add(obj)
+
+    def __keep(self, name):
+        previous = self._reload
+        names = [name] + list(previous.nested.get(name, ()))
+        for n in names:
+            self._refs[n] = previous.refs[n]
+            self._defs[n] = previous.defs[n]
+            self._owned[n] = previous.owned[n]
+            self._nested[n] = previous.nested[n]
+        for obj in previous.owned[name]:
+            self.__own(obj)
+        for _, nested in self._building:
+            nested.update(names)
+
+    def __canonical(self, config):
+        # Same form for raw configs and compiled plans
+        if isinstance(config, str):
+            for cap_name, (exp, _) in self._str_cap.items():
+                found = exp.match(config)
+                if found:
+                    return self.__canonical(dict(found.groupdict(), **{"class": cap_name}))
+            return config
+        elif isinstance(config, list):
+            return [self.__canonical(n) for n in config]
+        elif isinstance(config, dict):
+            if config.get("class") == "import":
+                return None
+            return {k: self.__canonical(v) for k, v in config.items()}
+        return config
+
+    def __deps(self, config, deps):
+        if isinstance(config, list):
+            for n in config:
+                self.__deps(n, deps)
+        elif isinstance(config, dict):
+            if config.get("class") == "ref":
+                deps.add(config.get("name"))
+            for v in config.values():
+                self.__deps(v, deps)
+        return deps
+
+    def __previous(self, name, cls_name, definition, key):
+        """Return (object, kept) for the object named name in the config being
+        reloaded, or (None, False) when it has to be built."""
+        previous = self._reload
+        if previous is None or name not in previous.refs:
+            return None, False
+        obj = previous.refs[name]
+        if previous.defs.get(name) == key and not (self.__deps(definition, set()) & self._changed):
+            return obj, True
+        cls = self._classes.get(cls_name)
+        if hasattr(obj, 'reconfigure') and isinstance(cls, type) and isinstance(obj, cls):
+            return obj, False
+        return None, False
+
     def reset_refs(self):
         self._refs = {}
 
@@ -69,11 +290,26 @@ class Config:
         cls_name = config["class"]
         name = config.get("name",None)
 
+        tracked = name is not None and cls_name != "ref"
+        previous = None
+        if tracked:
+            definition = self.__canonical(config)
+            key = json.dumps(definition, sort_keys=True)
+            previous, kept = self.__previous(name, cls_name, definition, key)
+            if kept:
+                self.__keep(name)
+                return previous
+            self._building.append((set(), set()))
+
         for k in config:
             config[k] = self.__porcess_config(config[k])
 
         obj = None
-        if cls_name in self._class_list:
+        if previous is not None:
+            previous.reconfigure(**config)
+            obj = previous
+            self.__own(obj)
+        elif cls_name in self._class_list:
             obj = self._class_list[cls_name](**config)
         else:
             raise KeyError(f"Class '{cls_name}' not found")
@@ -82,13 +318,23 @@ class Config:
             if name is not None:
                 obj.name = name
             ret_val = obj
+        if tracked:
+            owned, nested = self._building.pop()
+            self._defs[name] = key
+            self._owned[name] = owned
+            self._nested[name] = nested
+            for _, enclosing in self._building:
+                enclosing.add(name)
+                enclosing.update(nested)
+            if self._reload is not None and previous is None:
+                self._changed.add(name)
         if name is not None:
             self._refs[name] = ret_val
         return ret_val
 
     def __porcess_config(self, config):
         if isinstance(config, str):
-            return self.parse_string(config)
+            return self.parse_string(config) if self._parse else config
         elif isinstance(config, list):
             tmp = config
             config = []
@@ -123,6 +369,10 @@ def get_import(imports, **kwargs):
     if isinstance(imports, list):
         vals = []
         for n in imports:
-            vals.append(importlib.import_module(n))
+            vals.append(get_import(n))
         return vals
-    return importlib.import_module(imports)
\ No newline at end of file
+    module = importlib.import_module(imports)
+    # Packages import their submodules lazily, load the ones they export
+    for sub in getattr(module, '__all__', ()):
+        importlib.import_module(f"{imports}.{sub}")
+    return module
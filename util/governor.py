@@ -0,0 +1,176 @@
+import os
+import threading
+import time
+import util.logger as logger
+import util.metrics as metrics
+import util.singleton as singleton
+import util.thread_pool as thread_pool
+from util.config import DataClass
+
+@singleton.Singleton
+class Governor:
+    """Shed effect load when the scheduler can not keep up.
+
+    Every interval the governor reads the missed deadlines and the busy
+    time of the EffectsUpdaters. It is under pressure when an updater
+    missed a deadline or a pool of updaters was busy for more than
+    1 - headroom of the interval. Under pressure the lowest priority
+    updater that can still shed load first switches to cached frames, when
+    its effects are periodic, then halves its rate down to its min_rate.
+    Once the busiest pool stays below 1 - recover for calm intervals the
+    highest priority degraded updater is restored one step. Updaters
+    without a min_rate keep their rate.
+
+    Render tasks are not watched: they miss deadlines when the wire can
+    not carry the refresh rate, which shedding effects can not fix, see
+    the rate_policy of LedController. The governor is off until a
+    "Governor" entry enables it.
+    """
+    def __init__(self) -> None:
+        self.enabled = False
+        self.interval = 1.0
+        self.headroom = 0.2
+        self.recover = 0.4
+        self.calm = 3
+        self.pool = None
+        self.updaters = []
+        self.cached = set()
+        self.samples = {}
+        self.calm_count = 0
+        self.stuck = False
+        self.last = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.load = metrics.Metrics.gauge("governor_load", "Busy fraction of the busiest pool")
+        self.missed = metrics.Metrics.counter("governor_missed_deadlines_total", "Missed deadlines seen by the governor")
+        self.sheds = metrics.Metrics.counter("governor_actions_total", "Load shedding steps", action="shed")
+        self.restores = metrics.Metrics.counter("governor_actions_total", "Load shedding steps", action="restore")
+
+    def add(self, updater):
+        """Manage an updater, it needs priority, min_rate, refresh_rate, rate,
+        set_rate(), cacheable(), enable_cache() and disable_cache()."""
+        with self.lock:
+            if updater in self.updaters:
+                return
+            self.updaters.append(updater)
+        self.__start()
+
+    def remove(self, updater):
+        with self.lock:
+            if updater in self.updaters:
+                self.updaters.remove(updater)
+            self.cached.discard(updater)
+        self.__stop_idle()
+
+    def __start(self):
+        if not self.enabled or self.thread is not None:
+            return
+        self.last = None
+        self.samples = {}
+        self.thread = thread_pool.TimeThread(self.__tick, self.interval, pool=self.pool, name="governor")
+        self.thread.start()
+
+    def __stop_idle(self):
+        if self.thread is not None and len(self.updaters) == 0:
+            self.thread.stop()
+            self.thread = None
+
+    def __sample(self):
+        # Missed deadlines and busiest pool load since the previous call
+        with self.lock:
+            threads = [u.thread for u in self.updaters]
+        samples = {}
+        missed = 0
+        busy = {}
+        for thread in threads:
+            info = thread.info()
+            if info is None:
+                continue
+            samples[info] = (info.missed, info.busy)
+            previous = self.samples.get(info)
+            if previous is None:
+                continue
+            missed += samples[info][0] - previous[0]
+            busy[thread.pool] = busy.get(thread.pool, 0.0) + samples[info][1] - previous[1]
+        self.samples = samples
+        # Busy fraction of the workers of each pool
+        return missed, max([b / pool.workers for pool, b in busy.items()], default=0.0)
+
+    def __tick(self):
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        missed, busy = self.__sample()
+        last, self.last = self.last, now
+        if last is None:
+            return
+        load = busy / (now - last)
+        self.load.set(load)
+        self.missed.inc(missed)
+        if missed > 0 or load > 1 - self.headroom:
+            self.calm_count = 0
+            self.__shed("%d missed deadlines, load %.0f%%", missed, load * 100)
+        elif load < 1 - self.recover:
+            self.calm_count += 1
+            if self.calm_count >= self.calm:
+                self.calm_count = 0
+                self.__restore("load %.0f%%", load * 100)
+
+    def __shed(self, reason, *args):
+        # reason and args are handed to the logger unformatted
+        with self.lock:
+            updaters = sorted(self.updaters, key=lambda u: (u.priority, -u.rate))
+        for updater in updaters:
+            if updater not in self.cached and not updater.cache and updater.cacheable():
+                updater.enable_cache()
+                self.cached.add(updater)
+                action, value = "switched to cached frames", ()
+            elif updater.min_rate is not None and updater.rate > updater.min_rate:
+                updater.set_rate(max(updater.min_rate, updater.rate / 2))
+                action, value = "rate lowered to %.1f Hz", (updater.rate,)
+            else:
+                continue
+            self.sheds.inc()
+            self.stuck = False
+            logger.info("Governor: " + reason + ", %s " + action, *args, updater.name, *value)
+            return
+        if not self.stuck:
+            self.stuck = True
+            logger.error("Governor: " + reason + ", no updater left to degrade", *args)
+
+    def __restore(self, reason, *args):
+        with self.lock:
+            updaters = sorted(self.updaters, key=lambda u: -u.priority)
+        for updater in updaters:
+            if updater.rate < updater.refresh_rate:
+                updater.set_rate(min(updater.refresh_rate, updater.rate * 2))
+                action, value = "rate restored to %.1f Hz", (updater.rate,)
+            elif updater in self.cached:
+                updater.disable_cache()
+                self.cached.discard(updater)
+                action, value = "back to computed frames", ()
+            else:
+                continue
+            self.restores.inc()
+            self.stuck = False
+            logger.info("Governor: " + reason + ", %s " + action, *args, updater.name, *value)
+            return
+
+def _after_fork():
+    # A forked child governs its own updaters
+    Governor.lock = threading.Lock()
+    Governor.updaters = []
+    Governor.cached = set()
+    Governor.thread = None
+
+os.register_at_fork(after_in_child=_after_fork)
+
+@DataClass(name="Governor")
+def configure_governor(enable=True, interval=1.0, headroom=0.2, recover=0.4, calm=3, pool=None, **kwargs):
+    Governor.enabled = enable
+    Governor.interval = interval
+    Governor.headroom = headroom
+    Governor.recover = recover
+    Governor.calm = calm
+    Governor.pool = pool
+    return Governor
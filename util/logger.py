@@ -1,9 +1,58 @@
+import atexit
 import logging
-from systemd.journal import JournalHandler
+import logging.handlers
+import os
+import queue
 import sys
-import traceback
+import time
+from util.config import DataClass
+
+try:
+    from systemd.journal import JournalHandler
+except ImportError:
+    JournalHandler = None
+
+class RateLimit(logging.Filter):
+    """Let through at most burst records per call site, refilled at rate
+    records per second. The next record let through tells how many were
+    suppressed. A rate of 0 disables the limit.
+
+    Only warnings and errors are limited, lifecycle and audit messages
+    always pass. A lower level record opts in with
+    extra={"ratelimit": True}."""
+    def __init__(self, rate=1.0, burst=5):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.sites = {}
+
+    def filter(self, record):
+        if self.rate <= 0:
+            return True
+        if record.levelno < logging.WARNING and not getattr(record, "ratelimit", False):
+            return True
+        now = time.monotonic()
+        key = (record.pathname, record.lineno)
+        tokens, last, suppressed = self.sites.get(key, (self.burst, now, 0))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self.sites[key] = (tokens, now, suppressed + 1)
+            return False
+        self.sites[key] = (tokens - 1, now, 0)
+        if suppressed > 0:
+            record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+        return True
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    # Hand the record over as is, the listener thread formats the message
+    # and the traceback
+    def prepare(self, record):
+        return record
 
 class Logger(object):
+    """Log through a queue: the caller only enqueues the record, a listener
+    thread formats it and writes to stdout and, when systemd is installed,
+    to the journal."""
     __instance = None
     def __new__(cls):
         if cls.__instance is None:
@@ -11,29 +60,63 @@ class Logger(object):
             cls.__instance.__initialized = False
         return cls.__instance
 
-    def __init__(self):      
+    def __init__(self):
         if(self.__initialized): return
         self.log = logging.getLogger('led_conn')
-        self.log.addHandler(JournalHandler())
-        self.log.setLevel(logging.DEBUG)
+        self.log.setLevel(logging.INFO)
+        self.limit = RateLimit()
+        self.log.addFilter(self.limit)
 
+        self.handlers = []
+        if JournalHandler is not None:
+            self.handlers.append(JournalHandler())
         handler = logging.StreamHandler(sys.stdout)
-        handler.setLevel(logging.DEBUG)
         formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
         handler.setFormatter(formatter)
-        self.log.addHandler(handler)
+        self.handlers.append(handler)
+
+        self.handler = _QueueHandler(queue.SimpleQueue())
+        self.log.addHandler(self.handler)
+        self.listener = None
+        self.__listen()
+        atexit.register(self.__stop)
+        os.register_at_fork(after_in_child=self.__listen)
         self.__initialized = True
 
+    def __listen(self):
+        # Also runs in forked children, where the listener thread is gone
+        self.handler.queue = queue.SimpleQueue()
+        self.listener = logging.handlers.QueueListener(self.handler.queue, *self.handlers, respect_handler_level=True)
+        self.listener.start()
+
+    def __stop(self):
+        # Write what is still queued on exit
+        self.listener.stop()
+
+@DataClass(name="Logger")
+def configure_logger(level="INFO", rate=1.0, burst=5, **kwargs):
+    """Set the level, a logging level name, and the per call site rate
+    limit."""
+    log = Logger()
+    log.log.setLevel(level.upper() if isinstance(level, str) else level)
+    log.limit.rate = rate
+    log.limit.burst = burst
+    return log
+
 def debug(msg, *args, **kwargs):
-    Logger().log.debug(msg, *args, **kwargs)
+    Logger().log.debug(msg, *args, stacklevel=2, **kwargs)
 
 def info(msg, *args, **kwargs):
-    Logger().log.debug(msg, *args, **kwargs)
+    Logger().log.info(msg, *args, stacklevel=2, **kwargs)
+
+def warning(msg, *args, **kwargs):
+    Logger().log.warning(msg, *args, stacklevel=2, **kwargs)
 
 def error(msg, *args, **kwargs):
     if isinstance(msg, Exception):
-        Logger().log.error(traceback.format_exc())
-    Logger().log.error(msg, *args, **kwargs)
+        # The traceback is formatted by the listener
+        kwargs.setdefault('exc_info', msg)
+    Logger().log.error(msg, *args, stacklevel=2, **kwargs)
 
 def exception(msg, *args, **kwargs):
-    Logger().log.exception(msg, *args, **kwargs)
\ No newline at end of file
+    Logger().log.exception(msg, *args, stacklevel=2, **kwargs)
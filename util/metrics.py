@@ -0,0 +1,239 @@
+import array
+import bisect
+import http.server
+import os
+import socketserver
+import threading
+import time
+import util.singleton as singleton
+from util.config import DataClass
+
+_IMPORT_TIME = time.monotonic()
+
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+QUANTILES = (0.5, 0.9, 0.99)
+
+def _labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+def process_uptime():
+    """Seconds since the process was started, interpreter start up included
+    when /proc is available."""
+    try:
+        with open("/proc/self/stat", 'r') as file:
+            # Fields after the command name, starttime is field 22 of stat
+            fields = file.read().rsplit(")", 1)[1].split()
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return time.monotonic() - _IMPORT_TIME
+
+class Counter:
+    type = "counter"
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, value=1):
+        self.value += value
+
+    def render(self):
+        return [f"{self.name}{_labels(self.labels)} {self.value}"]
+
+class Gauge(Counter):
+    type = "gauge"
+    def set(self, value):
+        self.value = value
+
+class Histogram:
+    """Cumulative buckets plus a ring of the last ``window`` samples for
+    rolling quantiles. Meant to have a single writer thread; observe() does
+    not take any lock.
+    """
+    type = "histogram"
+    def __init__(self, name, labels, buckets=BUCKETS, window=256):
+        self.name = name
+        self.labels = labels
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.window = array.array('d', bytes(8 * window))
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.window[self.count % len(self.window)] = value
+        self.count += 1
+
+    def samples(self):
+        return sorted(self.window[:min(self.count, len(self.window))])
+
+    def mean(self):
+        n = min(self.count, len(self.window))
+        return sum(self.window[:n]) / n if n > 0 else 0.0
+
+    def render(self):
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append(f"{self.name}_bucket{_labels(self.labels, le=bound)} {total}")
+        lines.append(f"{self.name}_bucket{_labels(self.labels, le='+Inf')} {self.count}")
+        lines.append(f"{self.name}_sum{_labels(self.labels)} {self.sum}")
+        lines.append(f"{self.name}_count{_labels(self.labels)} {self.count}")
+        return lines
+
+    def render_window(self):
+        lines = []
+        samples = self.samples()
+        if len(samples) == 0:
+            return lines
+        for q in QUANTILES:
+            value = samples[min(len(samples) - 1, int(q * len(samples)))]
+            lines.append(f"{self.name}_window{_labels(self.labels, quantile=q)} {value}")
+        return lines
+
+class Rate(Histogram):
+    """Histogram of the interval between ticks, exported as achieved rate."""
+    type = "gauge"
+    def __init__(self, name, labels, window=256):
+        super().__init__(name, labels, window=window)
+        self.last = None
+
+    def tick(self, now=None):
+        now = time.perf_counter() if now is None else now
+        if self.last is not None:
+            self.observe(now - self.last)
+        self.last = now
+
+    def render(self):
+        mean = self.mean()
+        return [f"{self.name}{_labels(self.labels)} {1/mean if mean > 0 else 0.0}"]
+
+class TimedLock:
+    """Lock that observes, into a histogram, how long every acquire waited.
+    The sample is recorded once the lock is held, so the histogram keeps a
+    single writer."""
+    def __init__(self, histogram, lock=None):
+        self.histogram = histogram
+        self.lock = lock if lock is not None else threading.Lock()
+
+    def acquire(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.histogram.observe(time.perf_counter() - start)
+        return True
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        self.release()
+
+@singleton.Singleton
+class Metrics:
+    def __init__(self) -> None:
+        self._metrics = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def __get(self, cls, name, help, labels, **kwargs):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = cls(name, labels, **kwargs)
+                    self._metrics[key] = metric
+                    self._help.setdefault(name, (help, metric.type))
+        return metric
+
+    def counter(self, name, help="", **labels):
+        return self.__get(Counter, name, help, labels)
+
+    def gauge(self, name, help="", **labels):
+        return self.__get(Gauge, name, help, labels)
+
+    def histogram(self, name, help="", **labels):
+        return self.__get(Histogram, name, help, labels)
+
+    def rate(self, name, help="", **labels):
+        return self.__get(Rate, name, help, labels)
+
+    def render(self):
+        """Return every metric in Prometheus text exposition format."""
+        with self._lock:
+            metrics = sorted(self._metrics.items(), key=lambda item: item[0])
+        lines = []
+        windows = []
+        name = None
+        for key, metric in metrics:
+            if key[0] != name:
+                name = key[0]
+                help, type = self._help[name]
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {type}")
+                if type == "histogram":
+                    windows.append(f"# HELP {name}_window {help}, quantiles of the last samples")
+                    windows.append(f"# TYPE {name}_window gauge")
+            lines.extend(metric.render())
+            if type == "histogram":
+                windows.extend(metric.render_window())
+        return "\n".join(lines + windows) + "\n"
+
+class _HttpHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = Metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class _UnixHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.wfile.write(Metrics.render().encode())
+
+@DataClass(name="StatsServer")
+class StatsServer:
+    """Serve Metrics.render() over HTTP on host:port and/or on a Unix socket.
+
+    The shipped configs do not start it. To enable it add an entry such as
+    {"class": "StatsServer", "name": "Stats", "port": 9108} for HTTP on the
+    loopback interface, or "socket": "/run/leds/stats.sock" for a socket
+    only its owner and group can open. Set "host": "0.0.0.0" only on a
+    trusted network, the endpoint has no authentication.
+    """
+    def __init__(self, port=None, host="127.0.0.1", socket=None, **kwargs):
+        self.servers = []
+        if port is not None:
+            self.servers.append(http.server.ThreadingHTTPServer((host, port), _HttpHandler))
+        if socket is not None:
+            if os.path.exists(socket):
+                os.unlink(socket)
+            self.servers.append(socketserver.ThreadingUnixStreamServer(socket, _UnixHandler))
+            os.chmod(socket, 0o660)
+        for server in self.servers:
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def reconfigure(self, port=None, host="127.0.0.1", socket=None, **kwargs):
+        self.stop()
+        self.__init__(port, host, socket)
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.servers = []
@@ -1,57 +1,312 @@
-import datetime
-import multiprocessing as mp
+import asyncio
+import heapq
+import itertools
+import os
 import threading
 import time
+import weakref
+import util.logger as logger
+import util.metrics as metrics
 from util.config import DataClass
+
+CATCH_UP_POLICIES = ("skip", "burst")
+# Scheduling policies a pool may give its workers, see ThreadPool
+SCHED_POLICIES = {"other": "SCHED_OTHER", "batch": "SCHED_BATCH", "idle": "SCHED_IDLE",
+                  "fifo": "SCHED_FIFO", "rr": "SCHED_RR"}
+
+# Event loop and executor the pools schedule on instead of their own thread
+_loop = None
+_executor = None
+
+def use_loop(loop, executor=None):
+    """Run the pools started from now on as tasks of loop. Tasks started with
+    blocking=True run in executor (the loop default when None). Pass None to
+    go back to one thread per pool."""
+    global _loop, _executor
+    _loop = loop
+    _executor = executor
+
+def get_loop():
+    return _loop
+
+_default = None
+_pools = weakref.WeakSet()
+
+def _after_fork():
+    # Threads do not survive a fork, neither do the tasks they ran: a forked
+    # child starts with empty pools
+    global _loop, _executor
+    _loop = None
+    _executor = None
+    for pool in list(_pools):
+        pool.lock = threading.Condition()
+        pool.tasks = []
+        pool.queue = []
+        pool.threads = []
+        pool.generation += 1
+        pool.runner = None
+        pool.loop = None
+
+os.register_at_fork(after_in_child=_after_fork)
+
+def default_pool():
+    """Pool of the TimeThreads started without one, created on first use
+    with one worker per CPU. A ThreadPool configured with default=True
+    replaces it."""
+    global _default
+    if _default is None:
+        _default = ThreadPool(workers=os.cpu_count() or 1, name="default")
+    return _default
+
 @DataClass(name="ThreadPool")
 class ThreadPool:
+    """Run periodic tasks on a number of worker threads, each task on one
+    worker at a time, the earliest deadline first.
+
+    The workers can be pinned to the CPUs in affinity and given a
+    scheduling policy ("fifo" and "rr" are real time, with priority 1-99)
+    and a nice value, so a render pool keeps submitting frames while the
+    effects compute. Settings the process is not allowed to apply are
+    logged and ignored. With an event loop (see use_loop) the tasks run on
+    the loop instead and these settings do not apply.
+    """
     class TaskInfo:
-        def __init__(self, func, frame_time) -> None:
+        def __init__(self, func, frame_time, catch_up="skip", max_burst=4, name=None, blocking=False) -> None:
+            if catch_up not in CATCH_UP_POLICIES:
+                raise KeyError(f"Catch up policy '{catch_up}' not found")
             self.func = func
             self.last_update = 0
             self.frame_time = frame_time
-            self.next_update = datetime.datetime.now()
+            self.catch_up = catch_up
+            self.max_burst = max_burst
+            self.blocking = blocking
+            self.next_update = time.monotonic_ns()
+            self.active = True
+            # Worker thread running the task, None when it waits
+            self.running = None
+            # Metrics are labelled by name, an empty one would be shared
+            self.name = name if name else getattr(func, '__qualname__', str(func))
+            self.jitter = metrics.Metrics.histogram("scheduler_jitter_seconds", "Delay between a task deadline and its start", task=self.name)
+            self.fps = metrics.Metrics.rate("task_fps", "Achieved task rate", task=self.name)
+            self.missed_total = metrics.Metrics.counter("task_missed_deadlines_total", "Deadlines dropped by the scheduler", task=self.name)
+            self.busy_total = metrics.Metrics.counter("task_busy_seconds_total", "Time spent running the task", task=self.name)
+
+        @property
+        def missed(self):
+            return self.missed_total.value
+
+        @property
+        def busy(self):
+            return self.busy_total.value
 
-        def run(self):
-            self.last_update = datetime.datetime.now()
+        @property
+        def frame_time(self):
+            return self._frame_time
+
+        @frame_time.setter
+        def frame_time(self, frame_time):
+            self._frame_time = frame_time
+            self.period = max(1, int(frame_time * 1e9))
+
+        def run(self, now):
+            self.jitter.observe((now - self.next_update) / 1e9)
+            self.fps.tick(now / 1e9)
+            self.last_update = now
+            start = time.monotonic_ns()
             self.func()
-            self.next_update = self.last_update + datetime.timedelta(seconds=self.frame_time)
+            # Fixed rate: the next deadline only depends on the previous one
+            self.next_update += self.period
+            now = time.monotonic_ns()
+            self.busy_total.inc((now - start) / 1e9)
+            if self.next_update <= now:
+                behind = (now - self.next_update) // self.period + 1
+                if self.catch_up == "burst":
+                    behind = max(0, behind - self.max_burst)
+                self.missed_total.inc(behind)
+                self.next_update += behind * self.period
             return self.next_update
 
         def __str__(self):
-            return f"{self.func=} {self.frame_time=}"
+            return f"{self.func=} {self.frame_time=} {self.missed=}"
     
         def __repr__(self):
             return str(self)
     
-    def __init__(self, **kwargs):
+    def __init__(self, catch_up="skip", max_burst=4, workers=1, affinity=None, policy=None, priority=0, nice=None,
+                 default=False, name="", **kwargs):
+        if catch_up not in CATCH_UP_POLICIES:
+            raise KeyError(f"Catch up policy '{catch_up}' not found")
+        if policy is not None and policy not in SCHED_POLICIES:
+            raise KeyError(f"Scheduling policy '{policy}' not found")
+        self.catch_up = catch_up
+        self.max_burst = max_burst
+        self.workers = max(1, workers)
+        self.affinity = affinity
+        self.policy = policy
+        self.priority = priority
+        self.nice = nice
+        self.name = name
         self.tasks = []
-        self.thread= None
+        self.queue = []
+        self.seq = itertools.count()
+        self.threads = []
+        # Bumped by __join, workers of an older generation exit
+        self.generation = 0
+        self.runner = None
+        self.loop = None
         self._stop = False
-        self.lock = mp.Lock()
+        self.lock = threading.Condition()
+        _pools.add(self)
+        if default:
+            global _default
+            _default = self
 
-    def __run(self):
-        self._stop = False
+    def reconfigure(self, catch_up="skip", max_burst=4, workers=1, affinity=None, policy=None, priority=0, nice=None,
+                    default=False, **kwargs):
+        if catch_up not in CATCH_UP_POLICIES:
+            raise KeyError(f"Catch up policy '{catch_up}' not found")
+        if policy is not None and policy not in SCHED_POLICIES:
+            raise KeyError(f"Scheduling policy '{policy}' not found")
+        with self.lock:
+            self.catch_up = catch_up
+            self.max_burst = max_burst
+            for t in self.tasks:
+                t.catch_up = catch_up
+                t.max_burst = max_burst
+            restart = (max(1, workers), affinity, policy, priority, nice) != \
+                (self.workers, self.affinity, self.policy, self.priority, self.nice)
+            self.workers = max(1, workers)
+            self.affinity = affinity
+            self.policy = policy
+            self.priority = priority
+            self.nice = nice
+            running = len(self.threads) > 0
+        if default:
+            global _default
+            _default = self
+        if restart and running:
+            # New workers pick up the settings
+            self.__join()
+            self.__start()
+
+    def configure_thread(self):
+        """Apply the affinity, policy and nice value of the pool to the
+        calling thread."""
+        settings = []
+        if self.affinity is not None:
+            settings.append(("affinity", lambda: os.sched_setaffinity(0, self.affinity)))
+        if self.policy is not None:
+            settings.append(("policy", lambda: os.sched_setscheduler(0, getattr(os, SCHED_POLICIES[self.policy]),
+                                                                      os.sched_param(self.priority))))
+        if self.nice is not None:
+            settings.append(("nice", lambda: os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self.nice)))
+        for setting, apply in settings:
+            try:
+                apply()
+            except (OSError, AttributeError) as e:
+                logger.error("ThreadPool %s: can not set %s: %s", self.name, setting, e)
+
+    def __push(self, task_info):
+        heapq.heappush(self.queue, (task_info.next_update, next(self.seq), task_info))
+
+    def __run(self, generation):
+        self.configure_thread()
+        with self.lock:
+            while self._stop == False and self.generation == generation:
+                if len(self.queue) == 0:
+                    self.lock.wait()
+                    continue
+                next_update, _, task_info = self.queue[0]
+                if not task_info.active:
+                    heapq.heappop(self.queue)
+                    continue
+                now = time.monotonic_ns()
+                if now < next_update:
+                    self.lock.wait((next_update - now) / 1e9)
+                    continue
+                heapq.heappop(self.queue)
+                task_info.running = threading.current_thread()
+                self.lock.release()
+                try:
+                    task_info.run(now)
+                except Exception as e:
+                    logger.exception(e)
+                finally:
+                    self.lock.acquire()
+                    task_info.running = None
+                if task_info.active:
+                    self.__push(task_info)
+                else:
+                    # stop() may wait for the task to return
+                    self.lock.notify_all()
+
+    async def __run_async(self):
+        # Same schedule as __run, waiting on the loop instead of a thread
         while self._stop == False:
-            now = datetime.datetime.now()
-            next = None
+            self.wakeup.clear()
+            task_info = None
+            delay = None
+            with self.lock:
+                if len(self.queue) > 0:
+                    next_update, _, task_info = self.queue[0]
+                    now = time.monotonic_ns()
+                    if not task_info.active:
+                        heapq.heappop(self.queue)
+                        continue
+                    if now < next_update:
+                        delay = (next_update - now) / 1e9
+                        task_info = None
+                    else:
+                        heapq.heappop(self.queue)
+            if task_info is None:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                if task_info.blocking:
+                    await self.loop.run_in_executor(_executor, task_info.run, now)
+                else:
+                    task_info.run(now)
+            except Exception as e:
+                logger.exception(e)
             with self.lock:
-                for task_info in self.tasks:
-                    if next is None or next.next_update > task_info.next_update:
-                        next = task_info
-            if next is None:
-                self._stop = True
-                raise RuntimeError("Missing Task")
-            if now < next.next_update:
-                delta = (next.next_update - now).total_seconds()
-                if delta > 0:
-                    time.sleep(delta)
-            next.run()
+                if task_info.active:
+                    self.__push(task_info)
+        self.runner = None
+
+    def __spawn(self):
+        if self.runner is None:
+            self.wakeup = asyncio.Event()
+            self.runner = self.loop.create_task(self.__run_async())
+        else:
+            self.wakeup.set()
+
+    def __wake(self):
+        # Called with the lock held
+        self.lock.notify_all()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.__spawn)
 
     def __start(self):
-        if self.thread is None:
-            self.thread = threading.Thread(target=self.__run)
-            self.thread.start()
+        if self.loop is None and _loop is not None and len(self.threads) == 0:
+            self.loop = _loop
+        if self.loop is not None:
+            with self.lock:
+                self._stop = False
+                self.__wake()
+            return
+        with self.lock:
+            if len(self.threads) > 0:
+                return
+            self._stop = False
+            for n in range(self.workers):
+                name = f"{self.name or 'pool'}-{n}"
+                self.threads.append(threading.Thread(target=self.__run, args=(self.generation,), name=name))
+            threads = list(self.threads)
+        for thread in threads:
+            thread.start()
 
     def get_task_info(self, task):
         with self.lock:
@@ -60,49 +315,95 @@ class ThreadPool:
                     return t
         return None
 
-    def start(self, task, frame_time):
+    def start(self, task, frame_time, catch_up=None, name=None, blocking=False):
         task_info = self.get_task_info(task)
-        if task_info is None:
-            task_info = ThreadPool.TaskInfo(task, frame_time)
-            with self.lock:
+        with self.lock:
+            if task_info is None:
+                task_info = ThreadPool.TaskInfo(task, frame_time,
+                                                catch_up if catch_up is not None else self.catch_up,
+                                                self.max_burst, name, blocking)
                 self.tasks.append(task_info)
-        if frame_time < task_info.frame_time:
-            task_info.frame_time = frame_time
+                self.__push(task_info)
+            if frame_time < task_info.frame_time:
+                task_info.frame_time = frame_time
+            self.__wake()
         self.__start()
         return task
 
+    def set_frame_time(self, task, frame_time):
+        with self.lock:
+            for t in self.tasks:
+                if t.func == task:
+                    t.frame_time = frame_time
+            self.__wake()
+
     def stop(self, task):
         with self.lock:
             for t in self.tasks:
                 if t.func == task:
-                    self.tasks.remove(t)                
+                    t.active = False
+                    self.tasks.remove(t)
+                    # Return once another worker running it is done, a task
+                    # stopping itself returns right away
+                    while t.running is not None and t.running is not threading.current_thread():
+                        self.lock.wait()
                     break
-        if len(self.tasks) == 0:
-            self._stop = True
-            if self.thread is not None:
-                self.thread.join()
-                self.thread = None
-        
+            stop = len(self.tasks) == 0
+            self.__wake()
+        if stop:
+            self.__join()
+
     def stop_all(self):
-        if self.thread is not None:
-            self._stop = True
-            self.thread.join()
-            self.thread = None
+        with self.lock:
+            for t in self.tasks:
+                t.active = False
             self.tasks = []
+            self.queue = []
+        self.__join()
+
+    def __join(self):
+        with self.lock:
+            self._stop = True
+            self.generation += 1
+            threads = self.threads
+            self.threads = []
+            self.__wake()
+        # A task may stop its own pool, its worker exits when it returns
+        for thread in threads:
+            if thread is not threading.current_thread():
+                thread.join()
+
+    def get_missed(self):
+        with self.lock:
+            return {t.func: t.missed for t in self.tasks}
 
 
 class TimeThread:
-    def __init__(self, _func, frame_time, pool=None, *kwargs):
+    def __init__(self, _func, frame_time, pool=None, catch_up=None, name=None, blocking=False, *kwargs):
         self._func = _func
+        self.name = name
+        self.blocking = blocking
         self.frame_time = frame_time
-        self.pool = pool if pool is not None else ThreadPool()
+        self.catch_up = catch_up
+        self.pool = pool if pool is not None else default_pool()
         self.task_id = None
 
     def start(self):
         if self.task_id is None:
-            self.task_id = self.pool.start(self._func, self.frame_time)
+            self.task_id = self.pool.start(self._func, self.frame_time, self.catch_up, self.name, self.blocking)
     
+    def set_frame_time(self, frame_time):
+        self.frame_time = frame_time
+        if self.task_id is not None:
+            self.pool.set_frame_time(self._func, frame_time)
+
+    def info(self):
+        """The TaskInfo of the running task, None when stopped."""
+        if self.task_id is None:
+            return None
+        return self.pool.get_task_info(self._func)
+
     def stop(self):
         if self.task_id is not None:
-            self.pool.stop_all()
+            self.pool.stop(self._func)
             self.task_id = None